@@ -0,0 +1,75 @@
+"""
+Import-time benchmarks: cold-start cost of the package, in fresh
+interpreters.
+
+Each statement runs in a new python process, timed from inside it so
+interpreter startup isn't counted; we report the best & median of
+--repeat runs, in milliseconds.
+
+    python benchmarks/bench_import.py --output imports.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from bench_projection import git_revision
+
+STATEMENTS = [
+    ('package', 'import marshmallow_select'),
+    ('plan', 'from marshmallow_select import ProjectionPlan'),
+    ('schema_filter', 'from marshmallow_select import SchemaFilter'),
+    # for reference: what we can't avoid once projecting
+    ('sqlalchemy_orm', 'import sqlalchemy.orm'),
+    ('marshmallow', 'import marshmallow'),
+]
+
+TIMER = '''
+import time
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start)
+'''
+
+
+def time_import(statement, repeat):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    timings = []
+    for _ in range(repeat):
+        out = subprocess.check_output(
+            [sys.executable, '-c', TIMER.format(statement)], env=env)
+        timings.append(float(out) * 1e3)
+    return {'best_ms': min(timings), 'median_ms': statistics.median(timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--output', help='write results here (JSON)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='fresh interpreters per statement')
+    args = parser.parse_args()
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'imports': {name: dict(time_import(statement, args.repeat),
+                               statement=statement)
+                    for name, statement in STATEMENTS},
+    }
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
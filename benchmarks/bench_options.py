@@ -0,0 +1,65 @@
+"""
+How the cost of applying a projection's loader options scales with
+schema width (columns per model) & depth (levels of nesting).
+
+Compares applying options one qry.options() call at a time (what
+project_query used to do) with a single call.
+
+    python benchmarks/bench_options.py
+"""
+import timeit
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy.orm import sessionmaker
+
+from marshmallow_select.loaders import collect_loader_options
+from marshmallow_select.planner import SchemaProjectionGenerator
+
+from graph import build_graph
+
+
+def run(width, depth, number=200):
+    graph = build_graph(width, depth)
+    model, schema = graph.root, graph.schema
+    engine = sa.create_engine('sqlite://')
+    graph.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    qry = session.query(model)
+
+    cfg = SchemaProjectionGenerator(schema(), model).config
+    options = collect_loader_options(cfg, loader=orm.joinedload)
+
+    def one_at_a_time():
+        new_qry = qry
+        for option in options:
+            new_qry = new_qry.options(option)
+        return new_qry
+
+    def all_at_once():
+        return qry.options(*options)
+
+    per_option = min(timeit.repeat(one_at_a_time, number=number, repeat=3))
+    single = min(timeit.repeat(all_at_once, number=number, repeat=3))
+    return {
+        'width': width,
+        'depth': depth,
+        'options': len(options),
+        'one_at_a_time_us': per_option / number * 1e6,
+        'all_at_once_us': single / number * 1e6,
+    }
+
+
+def main():
+    print('{:>5} {:>5} {:>7} {:>14} {:>14}'.format(
+        'width', 'depth', 'options', 'one-at-a-time', 'all-at-once'))
+    for width in (5, 20, 40):
+        for depth in (1, 3, 5):
+            result = run(width, depth)
+            print('{width:>5} {depth:>5} {options:>7} '
+                  '{one_at_a_time_us:>12.1f}us {all_at_once_us:>12.1f}us'
+                  .format(**result))
+
+
+if __name__ == '__main__':
+    main()
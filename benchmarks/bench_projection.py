@@ -0,0 +1,134 @@
+"""
+Projection benchmarks over synthetic model graphs (see graph.py):
+
+  config    SchemaProjectionGenerator(...).config, uncached
+  project   project_query with a ready-made config
+  e2e       query + dump(many=True) rows/sec, unfiltered vs filtered,
+            vs SchemaFilter.to_select (no ORM, no marshmallow)
+
+Results go to stdout as JSON, or to --output; compare two runs with
+compare.py.
+
+    python benchmarks/bench_projection.py --output before.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import timeit
+
+import marshmallow
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from marshmallow_select import SchemaFilter
+from marshmallow_select.loaders import LoaderStrategy, project_query
+from marshmallow_select.planner import SchemaProjectionGenerator
+
+from graph import build_graph
+
+SHAPES = [
+    # width, depth, fanout
+    (5, 1, 1),
+    (20, 1, 1),
+    (5, 3, 1),
+    (5, 3, 2),
+    (20, 3, 2),
+    (5, 5, 1),
+]
+
+
+def unpack(result):
+    return getattr(result, 'data', result)
+
+
+def best_of(func, number, repeat=3):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def bench_shape(width, depth, fanout, rows, number):
+    graph = build_graph(width, depth, fanout)
+    engine = sa.create_engine('sqlite://')
+    graph.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    graph.populate(session, rows)
+
+    schema = graph.schema()
+    qry = session.query(graph.root)
+
+    def config():
+        return SchemaProjectionGenerator(schema, graph.root).config
+
+    cfg = config()
+    loader = LoaderStrategy('joinedload', collections='selectinload')
+
+    def project():
+        return project_query(qry, cfg, loader)
+
+    def e2e(query_fn):
+        def run():
+            session.expunge_all()
+            return unpack(graph.schema(many=True).dump(query_fn().all()))
+        return run
+
+    sf = SchemaFilter(graph.schema(), strategy='auto', project_columns=True)
+    total_rows = len(e2e(lambda: qry)())
+    unfiltered = best_of(e2e(lambda: qry), number=1)
+    filtered = best_of(e2e(lambda: sf(qry)), number=1)
+
+    plan = sf.to_select(graph.root)
+    core = best_of(lambda: plan.execute(session), number=1)
+
+    return {
+        'width': width,
+        'depth': depth,
+        'fanout': fanout,
+        'rows': total_rows,
+        'config_us': best_of(config, number) * 1e6,
+        'project_us': best_of(project, number) * 1e6,
+        'unfiltered_rows_per_sec': total_rows / unfiltered,
+        'filtered_rows_per_sec': total_rows / filtered,
+        'core_rows_per_sec': total_rows / core,
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--output', help='write results here (JSON)')
+    parser.add_argument('--rows', type=int, default=50,
+                        help='root rows to create per shape')
+    parser.add_argument('--number', type=int, default=50,
+                        help='iterations per timing of config/project')
+    args = parser.parse_args()
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'sqlalchemy': sa.__version__,
+        'marshmallow': marshmallow.__version__,
+        'benchmarks': [bench_shape(width, depth, fanout, args.rows,
+                                   args.number)
+                       for width, depth, fanout in SHAPES],
+    }
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Compare two bench_projection.py result files.
+
+    python benchmarks/compare.py before.json after.json
+"""
+import json
+import sys
+
+# metric -> whether bigger is better
+METRICS = [
+    ('config_us', False),
+    ('project_us', False),
+    ('unfiltered_rows_per_sec', True),
+    ('filtered_rows_per_sec', True),
+    ('core_rows_per_sec', True),
+]
+
+
+def shape(result):
+    return (result['width'], result['depth'], result['fanout'])
+
+
+def main(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    print('{} -> {}'.format(before.get('revision'), after.get('revision')))
+    old = {shape(result): result for result in before['benchmarks']}
+    for result in after['benchmarks']:
+        prev = old.get(shape(result))
+        if prev is None:
+            continue
+        print('width={} depth={} fanout={}'.format(*shape(result)))
+        for metric, bigger_is_better in METRICS:
+            # older result files predate some metrics
+            if metric not in result or metric not in prev:
+                continue
+            ratio = result[metric] / prev[metric]
+            change = ratio - 1 if bigger_is_better else 1 - ratio
+            print('  {:<24} {:>12.1f} {:>12.1f}  {:+.0%}'.format(
+                metric, prev[metric], result[metric], change))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
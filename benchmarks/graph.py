@@ -0,0 +1,83 @@
+"""
+Synthetic model graphs for benchmarking.
+
+build_graph(width, depth, fanout) makes a tree of models: every model
+has width string columns and fanout one-to-many collections, each
+pointing at its own model on the next level, depth levels deep. The
+matching schema serializes every column & every collection.
+"""
+from marshmallow import Schema
+from marshmallow.fields import Integer, List, Nested, String
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+
+
+class Graph(object):
+    def __init__(self, Base, models, root, schema, width, depth, fanout):
+        self.Base = Base
+        # keep every model alive; the declarative registry only holds
+        # weak references.
+        self.models = models
+        self.root = root
+        self.schema = schema
+        self.width = width
+        self.depth = depth
+        self.fanout = fanout
+
+    def populate(self, session, rows, children=2):
+        """
+        rows root objects, each with children objects in each of its
+        collections, all the way down.
+        """
+        def make(model, level, n):
+            objs = []
+            for i in range(n):
+                obj = model(**{'c{}'.format(col): 'v{}-{}'.format(i, col)
+                               for col in range(self.width)})
+                if level + 1 < self.depth:
+                    for branch in range(self.fanout):
+                        name = 'kids{}'.format(branch)
+                        child_model = model.__mapper__.relationships[name].mapper.class_
+                        setattr(obj, name, make(child_model, level + 1, children))
+                objs.append(obj)
+            return objs
+
+        session.add_all(make(self.root, 0, rows))
+        session.commit()
+
+
+def build_graph(width, depth, fanout=1):
+    Base = declarative_base()
+    models = []
+
+    def make_model(name, level, parent_name):
+        attrs = {
+            '__tablename__': name,
+            'id': sa.Column(sa.Integer, primary_key=True),
+        }
+        for col in range(width):
+            attrs['c{}'.format(col)] = sa.Column(sa.String(100))
+        if parent_name:
+            attrs['parent_id'] = sa.Column(sa.Integer,
+                                           sa.ForeignKey(parent_name + '.id'))
+
+        schema_attrs = {'id': Integer()}
+        for col in range(width):
+            schema_attrs['c{}'.format(col)] = String()
+
+        if level + 1 < depth:
+            for branch in range(fanout):
+                child_name = '{}_{}'.format(name, branch)
+                child_model, child_schema = make_model(child_name, level + 1,
+                                                       name)
+                attrs['kids{}'.format(branch)] = relationship(child_model)
+                schema_attrs['kids{}'.format(branch)] = List(Nested(child_schema))
+
+        model = type(name.upper(), (Base,), attrs)
+        schema = type(name.upper() + 'Schema', (Schema,), schema_attrs)
+        models.append(model)
+        return model, schema
+
+    root, schema = make_model('m', 0, None)
+    return Graph(Base, models, root, schema, width, depth, fanout)
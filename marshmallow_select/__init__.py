@@ -1,3 +1,49 @@
-from .schema_filter import (
-    SchemaFilter
-)
+"""
+The names below are imported from their submodules on first use, so
+that importing the package (e.g. for the pytest plugin, or in a worker
+which only applies precompiled plans) doesn't pull in marshmallow &
+all of SQLAlchemy up front.
+"""
+import importlib
+import sys
+
+# public name -> submodule defining it
+_exports = {
+    'InvalidFieldPath': 'schemas',
+    'MultiSchemaFilter': 'schema_filter',
+    'ProjectionCache': 'cache',
+    'ProjectionPlan': 'loaders',
+    'ProjectionStats': 'stats',
+    'SchemaFilter': 'schema_filter',
+    'SelectPlan': 'core',
+    'export_plans': 'plans',
+    'load_plans': 'plans',
+    'precompile': 'schema_filter',
+    'projection_cache': 'schema_filter',
+    'schema_for_fields': 'schemas',
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    try:
+        module_name = _exports[name]
+    except KeyError:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+    value = getattr(importlib.import_module('.' + module_name, __name__),
+                    name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
+
+
+# module-level __getattr__ is 3.7+ (PEP 562); import everything up
+# front before that
+if sys.version_info < (3, 7):
+    for _name in __all__:
+        globals()[_name] = __getattr__(_name)
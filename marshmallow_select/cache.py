@@ -0,0 +1,86 @@
+from collections import OrderedDict
+import threading
+
+
+class ProjectionCache(object):
+    """
+    Bounded LRU cache for projection configs.
+
+    Building a config means introspecting the schema & mapper at every
+    level of nesting, which is slow enough to matter per-request. The
+    result only depends on the schema class, the instance-level field
+    options & the model, so we can compute it once per shape and hand
+    out the same (read-only) config tree afterwards.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get_or_build(self, key, build):
+        return self.lookup(key, build)[0]
+
+    def lookup(self, key, build):
+        """
+        like get_or_build, but returns (value, whether it was a hit)
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                pass
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value, True
+            self.misses += 1
+
+        # NOTE: build outside the lock; worst case two
+        # threads build the same config & one of them wins, which is
+        # cheaper than serializing every miss.
+        value = build()
+        self.put(key, value)
+        return value, False
+
+    def put(self, key, value):
+        """
+        stores value for key as if it had just been built, e.g. for
+        configs loaded from disk (see plans)
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._trim()
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._trim()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'maxsize': self.maxsize,
+                'currsize': len(self._data),
+            }
+
+    def _trim(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
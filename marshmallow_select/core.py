@@ -0,0 +1,261 @@
+"""
+Core-level fast path for read-only endpoints: compiles a schema into
+plain select()s of labeled columns & builds dicts shaped like the
+schema's dump output straight from the rows, skipping ORM objects &
+marshmallow altogether.
+
+    plan = SchemaFilter(UserSchema()).to_select(User)
+    stmt = plan.statement.where(User.org_id == org_id).order_by(User.id)
+    data = plan.execute(session, stmt)
+
+To-one links are outer joined into the same select. Each collection
+is one more select, batched over the parent keys like selectinload.
+Values are whatever the driver returns; they don't go through the
+fields' formatting.
+
+Which links get selected comes from the projection config (see
+planner), so cyclic schemas stop where the ORM path would: at the
+first repeat, or at max_depth. There's no lazy loading to fall back
+on here, so the links past that are left out of the dicts.
+"""
+import itertools
+
+from marshmallow import fields
+from marshmallow.fields import Nested
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+from .mapper_index import mapper_index
+from .schemas import (
+    dump_field_names,
+    ensure_instance,
+    get_next_schema,
+    unwrap_field
+)
+
+# parent keys per IN (...) when fetching a collection
+BATCH_SIZE = 500
+
+SA_SELECT_TAKES_LIST = tuple(
+    int(part) for part in sa.__version__.split('.')[:2]) < (1, 4)
+
+
+class SelectPlan(object):
+    """
+    Result of SchemaFilter.to_select. statement selects the model's
+    rows; add where/order_by/limit to it (against the model itself)
+    and pass the result to execute.
+    """
+    def __init__(self, schema_inst, model, cfg, only_paths=None):
+        self.model = model
+        self.root = SelectNode(schema_inst, model, cfg,
+                               only_paths=only_paths)
+
+    @property
+    def statement(self):
+        return self.root.select()
+
+    def execute(self, bind, statement=None):
+        """
+        runs statement (default: all rows) plus one select per
+        collection on bind (a session, connection or engine) & returns
+        a list of dicts.
+        """
+        if statement is None:
+            statement = self.statement
+        rows = [row_mapping(row) for row in bind.execute(statement)]
+        return self.root.build(bind, rows)
+
+
+class SelectNode(object):
+    """
+    One select: an entity's columns plus those of the to-one links
+    joined onto it. For a collection, parent is the parent class & the
+    relationship's name; its select joins from (an alias of) the parent
+    so rows can be picked & grouped by the parent's key.
+
+    shape describes how to turn a row into a dict, per level:
+    (key labels, [(kind, dump key, payload), ...]). cfg is the
+    projection config for entity; links not in its childs aren't
+    selected.
+    """
+    def __init__(self, schema_inst, entity, cfg, only_paths=None,
+                 parent=None):
+        self._labels = itertools.count()
+        self._aliases = itertools.count()
+        self.columns = []
+        self.from_clause = entity
+        self.parent_columns = []
+        self.parent_labels = []
+        if parent is not None:
+            parent_cls, name = parent
+            parent_entity = self.alias(parent_cls)
+            link = getattr(parent_entity, name)
+            self.from_clause = orm.join(parent_entity, entity,
+                                        link.of_type(entity))
+            self.parent_columns = key_columns(parent_entity)
+            self.parent_labels = [self.add_column(column)
+                                  for column in self.parent_columns]
+            self.order_by = link.property.order_by or ()
+        else:
+            self.order_by = ()
+        self.shape = self.add_level(schema_inst, entity, cfg, only_paths)
+
+    def add_column(self, column):
+        label = 'c{}'.format(next(self._labels))
+        self.columns.append(column.label(label))
+        return label
+
+    def alias(self, cls):
+        # named explicitly; anonymous ones (like user_1) can clash with
+        # real table names
+        return orm.aliased(cls, name='a{}'.format(next(self._aliases)))
+
+    def add_level(self, schema_inst, entity, cfg, only_paths):
+        index = mapper_index(entity)
+        key_labels = [self.add_column(column)
+                      for column in key_columns(entity)]
+        items = []
+        for name in dump_field_names(schema_inst):
+            if only_paths and name not in only_paths:
+                continue
+            schema_field = schema_inst.fields[name]
+            field_attr = schema_field.attribute or name
+            key = dump_key(name, schema_field)
+            inner = unwrap_field(schema_field)
+            next_paths = only_paths.get(name) if only_paths else None
+            if isinstance(inner, Nested) and field_attr in index.relationships:
+                next_cfg = cfg['childs'].get(field_attr)
+                if next_cfg is None:
+                    # cut by a cycle, or past max_depth
+                    continue
+                next_schema = ensure_instance(get_next_schema(schema_inst, name))
+                link = index.links[field_attr]
+                pluck = is_pluck(inner)
+                if link.uselist:
+                    node = SelectNode(next_schema, link.target, next_cfg,
+                                      only_paths=next_paths,
+                                      parent=(index.class_, field_attr))
+                    items.append(('many', key, (node, pluck)))
+                else:
+                    target = self.alias(link.target)
+                    attr = getattr(entity, field_attr)
+                    self.from_clause = orm.outerjoin(self.from_clause, target,
+                                                     attr.of_type(target))
+                    shape = self.add_level(next_schema, target, next_cfg,
+                                           next_paths)
+                    items.append(('one', key, (shape, pluck)))
+            elif field_attr in index.columns:
+                label = self.add_column(getattr(entity, field_attr))
+                items.append(('column', key, label))
+            else:
+                raise ValueError("can't select {}.{} without the ORM".format(
+                    type(schema_inst).__name__, name))
+        return key_labels, items
+
+    def select(self):
+        stmt = select_columns(self.columns).select_from(self.from_clause)
+        if self.order_by:
+            stmt = stmt.order_by(*self.order_by)
+        return stmt
+
+    def fetch(self, bind, keys):
+        """
+        rows of this collection for the given parent keys, as
+        {parent key: [dict, ...]}
+        """
+        rows = []
+        for start in range(0, len(keys), BATCH_SIZE):
+            chunk = keys[start:start + BATCH_SIZE]
+            if len(self.parent_columns) == 1:
+                criterion = self.parent_columns[0].in_([k[0] for k in chunk])
+            else:
+                criterion = sa.tuple_(*self.parent_columns).in_(chunk)
+            stmt = self.select().where(criterion)
+            rows.extend(row_mapping(row) for row in bind.execute(stmt))
+
+        groups = {}
+        for row, data in zip(rows, self.build(bind, rows)):
+            parent_key = tuple(row[label] for label in self.parent_labels)
+            groups.setdefault(parent_key, []).append(data)
+        return groups
+
+    def build(self, bind, rows):
+        collections = {}
+        self.fetch_collections(bind, rows, self.shape, collections)
+        return [build_level(self.shape, row, collections) for row in rows]
+
+    def fetch_collections(self, bind, rows, shape, collections):
+        key_labels, items = shape
+        for kind, key, payload in items:
+            if kind == 'one':
+                self.fetch_collections(bind, rows, payload[0], collections)
+            elif kind == 'many':
+                node = payload[0]
+                keys = set()
+                for row in rows:
+                    parent_key = tuple(row[label] for label in key_labels)
+                    if None not in parent_key:
+                        keys.add(parent_key)
+                collections[node] = node.fetch(bind, sorted(keys))
+
+
+def build_level(shape, row, collections):
+    key_labels, items = shape
+    data = {}
+    for kind, key, payload in items:
+        if kind == 'column':
+            data[key] = row[payload]
+        elif kind == 'one':
+            next_shape, pluck = payload
+            if all(row[label] is None for label in next_shape[0]):
+                data[key] = None
+            else:
+                value = build_level(next_shape, row, collections)
+                data[key] = plucked(value) if pluck else value
+        else:
+            node, pluck = payload
+            parent_key = tuple(row[label] for label in key_labels)
+            values = collections[node].get(parent_key, [])
+            data[key] = [plucked(v) for v in values] if pluck else values
+    return data
+
+
+def plucked(data):
+    return next(iter(data.values()))
+
+
+def key_columns(entity):
+    """
+    primary key columns of a mapped class or an aliased() one, as
+    attributes of it
+    """
+    mapper = sa.inspect(entity).mapper
+    return [getattr(entity, mapper.get_property_by_column(column).key)
+            for column in mapper.primary_key]
+
+
+def dump_key(name, schema_field):
+    # data_key on marshmallow 3, dump_to on 2
+    return (getattr(schema_field, 'data_key', None) or
+            getattr(schema_field, 'dump_to', None) or
+            name)
+
+
+def is_pluck(field):
+    # Pluck is marshmallow 3 only
+    pluck_cls = getattr(fields, 'Pluck', None)
+    return pluck_cls is not None and isinstance(field, pluck_cls)
+
+
+def select_columns(columns):
+    # select(*columns) from SQLAlchemy 1.4 on (& only that in 2.0),
+    # select([columns]) before
+    if SA_SELECT_TAKES_LIST:
+        return sa.select(columns)
+    return sa.select(*columns)
+
+
+def row_mapping(row):
+    # rows are mappings themselves before SQLAlchemy 1.4
+    return getattr(row, '_mapping', row)
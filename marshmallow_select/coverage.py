@@ -0,0 +1,166 @@
+"""
+Tells you whether a schema "covers" a query, i.e. whether dumping the
+(filtered) query's results with the schema issues any more SQL.
+
+    report = check_coverage(UserSchema(), session.query(User))
+    if not report.covered:
+        print(report)
+"""
+from collections import namedtuple
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+# do_orm_execute (and with it, knowing which attribute a query is
+# loading) showed up in SQLAlchemy 1.4
+HAS_ORM_EXECUTE = hasattr(orm.SessionEvents, 'do_orm_execute')
+
+
+class RecordedQuery(namedtuple('RecordedQuery',
+                               ['statement', 'parameters', 'path'])):
+    """
+    path is the attribute being loaded, like 'User.images', or None if
+    the query wasn't a lazy/deferred load (or we couldn't tell).
+    """
+    def __str__(self):
+        if self.path:
+            return '{}\n    -- loading {}'.format(self.statement, self.path)
+        return str(self.statement)
+
+
+class QueryRecorder(object):
+    """
+    Context manager recording every statement sent through session's
+    engine while active. Without a session (or bind), records
+    statements from every engine & session.
+    """
+    def __init__(self, session=None, bind=None):
+        if bind is None:
+            bind = sa.engine.Engine if session is None else session.get_bind()
+        self.session = orm.Session if session is None else session
+        self.bind = bind
+        self.queries = []
+        self._pending_path = None
+
+    def __enter__(self):
+        sa.event.listen(self.bind, 'before_cursor_execute',
+                        self._before_cursor_execute)
+        if HAS_ORM_EXECUTE:
+            sa.event.listen(self.session, 'do_orm_execute',
+                            self._do_orm_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        sa.event.remove(self.bind, 'before_cursor_execute',
+                        self._before_cursor_execute)
+        if HAS_ORM_EXECUTE:
+            sa.event.remove(self.session, 'do_orm_execute',
+                            self._do_orm_execute)
+
+    def mark(self):
+        return len(self.queries)
+
+    def _do_orm_execute(self, orm_execute_state):
+        self._pending_path = loading_path(orm_execute_state)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        path, self._pending_path = self._pending_path, None
+        self.queries.append(RecordedQuery(statement, parameters, path))
+
+
+def loading_path(orm_execute_state):
+    if orm_execute_state.is_relationship_load:
+        path = orm_execute_state.loader_strategy_path
+        if path and len(path.path) >= 2:
+            mapper, prop = path.path[-2:]
+            return '{}.{}'.format(mapper.class_.__name__, prop.key)
+    elif orm_execute_state.is_column_load:
+        mapper = orm_execute_state.bind_mapper
+        compile_options = getattr(orm_execute_state.statement,
+                                  '_compile_options', None)
+        names = getattr(compile_options, '_only_load_props', None)
+        if mapper is None:
+            return None
+        elif names:
+            return ', '.join('{}.{}'.format(mapper.class_.__name__, name)
+                             for name in sorted(names))
+        else:
+            return '{} (refresh)'.format(mapper.class_.__name__)
+    return None
+
+
+class CoverageReport(object):
+    def __init__(self, fetch_queries, extra_queries, data=None):
+        self.fetch_queries = fetch_queries
+        self.extra_queries = extra_queries
+        self.data = data
+
+    @property
+    def covered(self):
+        return not self.extra_queries
+
+    @property
+    def paths(self):
+        """
+        attributes that were loaded during the dump, in order
+        """
+        seen = []
+        for query in self.extra_queries:
+            if query.path and query.path not in seen:
+                seen.append(query.path)
+        return seen
+
+    def __bool__(self):
+        return self.covered
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        if self.covered:
+            return 'covered ({} queries to fetch, 0 to dump)'.format(
+                len(self.fetch_queries))
+        lines = ['not covered: {} queries to fetch, {} to dump'.format(
+            len(self.fetch_queries), len(self.extra_queries))]
+        for i, query in enumerate(self.extra_queries, 1):
+            lines.append('{}. {}'.format(i, query))
+        return '\n'.join(lines)
+
+
+def check_coverage(schema, qry, session=None, schema_filter=None,
+                   **filter_kwargs):
+    """
+    Filters qry with schema, fetches it & dumps it with many=True,
+    recording which queries happen during the dump. filter_kwargs go to
+    SchemaFilter (unlazify defaults to True here), unless you pass an
+    existing schema_filter.
+    """
+    # imported here since the pytest plugin loads this module in every
+    # test run, whether or not it uses schemas
+    from .schema_filter import SchemaFilter
+    from .schemas import ensure_instance
+
+    schema_inst = ensure_instance(schema)
+    if session is None:
+        session = qry.session
+    if schema_filter is None:
+        filter_kwargs.setdefault('unlazify', True)
+        schema_filter = SchemaFilter(schema_inst, **filter_kwargs)
+
+    with QueryRecorder(session) as recorder:
+        objs = schema_filter(qry).all()
+        fetched = recorder.mark()
+        result = schema_inst.dump(objs, many=True)
+
+    data = getattr(result, 'data', result)
+    return CoverageReport(recorder.queries[:fetched],
+                          recorder.queries[fetched:],
+                          data=data)
+
+
+def assert_covers(schema, qry, session=None, schema_filter=None,
+                  **filter_kwargs):
+    report = check_coverage(schema, qry, session=session,
+                            schema_filter=schema_filter, **filter_kwargs)
+    assert report.covered, str(report)
+    return report
@@ -0,0 +1,257 @@
+"""
+The SQLAlchemy side of projecting: turning a config tree (see
+planner) into loader options. Nothing here needs marshmallow or looks
+at a schema, so a config built elsewhere can be applied as is (see
+ProjectionPlan.from_config).
+"""
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+from .mapper_index import mapper_index
+
+
+class LoaderStrategy(object):
+    """
+    Picks the loader (by name, e.g. 'joinedload') used to reach each
+    link in the projection.
+    """
+    def __init__(self, default, collections=None, overrides=None,
+                 stream=False):
+        self.default = loader_name(default)
+        self.collections = loader_name(collections or default)
+        self.overrides = {path: loader_name(loader) for path, loader
+                          in (overrides or {}).items()}
+        # see streaming
+        self.stream = stream
+
+    def loader_name(self, path, is_collection):
+        if path in self.overrides:
+            name = self.overrides[path]
+        elif is_collection:
+            name = self.collections
+        else:
+            name = self.default
+        if self.stream and is_collection:
+            return 'selectinload'
+        elif self.stream and name == 'defaultload':
+            return 'joinedload'
+        return name
+
+    def streaming(self):
+        """
+        copy for use with yield_per: every collection is selectinloaded
+        & to-one links are joined unless told otherwise.
+        """
+        return LoaderStrategy(self.default, collections=self.collections,
+                              overrides=self.overrides, stream=True)
+
+
+def loader_name(loader):
+    """
+    accepts orm.joinedload or 'joinedload'
+    """
+    name = getattr(loader, '__name__', loader)
+    if not callable(getattr(orm, name, None)):
+        raise ValueError('not a loader strategy:', loader)
+    return name
+
+
+def as_loader_strategy(loader):
+    if isinstance(loader, LoaderStrategy):
+        return loader
+    return LoaderStrategy(loader)
+
+
+class ProjectionPlan(object):
+    """
+    Frozen result of SchemaFilter.compile: the model it was built for
+    and the final tuple of loader options. Apply it with plan(qry), or
+    qry.options(*plan) if you prefer.
+    """
+    __slots__ = ('cls', 'options')
+
+    def __init__(self, cls, options):
+        object.__setattr__(self, 'cls', cls)
+        object.__setattr__(self, 'options', tuple(options))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ProjectionPlan is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('ProjectionPlan is immutable')
+
+    @classmethod
+    def from_config(cls, model, cfg, loader='defaultload', **kwargs):
+        """
+        plan for model straight from a config tree (e.g. one built
+        with planner.projection_config at some earlier point), without
+        looking at the schema again. Other keyword args go to
+        collect_loader_options.
+        """
+        return cls(model, collect_loader_options(cfg, loader, cls=model,
+                                                 **kwargs))
+
+    def __call__(self, qry):
+        return qry.options(*self.options)
+
+    def __iter__(self):
+        return iter(self.options)
+
+    def __len__(self):
+        return len(self.options)
+
+    def __repr__(self):
+        return '<ProjectionPlan {} ({} options)>'.format(self.cls.__name__,
+                                                        len(self.options))
+
+
+def entity_class(entity):
+    """
+    the mapped class for a mapped class or an aliased() one
+    """
+    return sa.inspect(entity).mapper.class_
+
+
+def get_next_class(mapper, name):
+    return mapper_index(mapper).links[name].target
+
+
+def project_query(qry, cfg, loader, project_columns=False, root=None,
+                  joined_paths=(), cls=None, raiseload=False, strict=False):
+    """
+    BFSs through config tree collecting loader options, then applies
+    them all at once (each qry.options call clones the query, so doing
+    it per-option gets expensive for wide or deep schemas).
+    """
+    options = collect_loader_options(cfg, loader,
+                                     project_columns=project_columns,
+                                     root=root, joined_paths=joined_paths,
+                                     cls=cls, raiseload=raiseload,
+                                     strict=strict)
+    return qry.options(*options)
+
+
+def collect_loader_options(cfg, loader, project_columns=False, root=None,
+                           joined_paths=(), cls=None, raiseload=False,
+                           strict=False):
+    """
+    walks the config tree & returns the list of loader options it
+    implies. loader is a LoaderStrategy, or a single loader for every
+    link. root is a Load(entity) to hang the options off of, for when
+    the query has more than one entity. Links in joined_paths (see
+    query_joined_paths) use contains_eager. With raiseload, links
+    outside the projection raise when accessed instead of being empty;
+    strict does the same for columns (which needs cls, & SQLAlchemy
+    1.4).
+
+    cls is the entity being projected. With it, options are bound to
+    attributes (User.images rather than 'images'), which is all
+    SQLAlchemy 2.0 accepts; subtypes need it too.
+    """
+    strategy = as_loader_strategy(loader)
+    wildcard_loader = 'raiseload' if raiseload or strict else 'noload'
+    # links cut by a cycle (see SchemaProjectionGenerator) need loading
+    # all the same, just not eagerly
+    cut_loader = 'raiseload' if raiseload or strict else 'lazyload'
+    options = []
+
+    def inner_collector(cfg, prefix, path, entity, local_names=None):
+        """
+        prefix is the path constructed by applying a series of load
+        strategies, as in
+
+        joinedload('foo').joinedload('bar').joinedload('baz')
+
+        or root if we are at the root. entity is the class (or alias)
+        at this level, or None if we're going by name.
+        """
+        options.append(option_with_prefix(prefix, wildcard_loader, '*'))
+
+        for name, child_cfg in cfg['childs'].items():
+            child_path = '.'.join(path + (name,))
+            if child_path in joined_paths:
+                child_loader = 'contains_eager'
+            else:
+                child_loader = strategy.loader_name(
+                    child_path, name in cfg['collections'])
+            if entity is not None:
+                child_entity = get_next_class(entity, name)
+            else:
+                child_entity = None
+            inner_collector(child_cfg,
+                            extend_prefix(prefix, child_loader,
+                                          attribute(entity, name)),
+                            path + (name,), child_entity)
+
+        for name in sorted(cfg['lazy']):
+            options.append(option_with_prefix(prefix, cut_loader,
+                                              attribute(entity, name)))
+
+        if project_columns and local_names is None:
+            names = sorted(cfg['load_only'] | cfg['required'])
+            options.append(option_with_prefix(
+                prefix, 'load_only', *[attribute(entity, n) for n in names]))
+        elif not project_columns:
+            for name in cfg['load_only']:
+                options.append(option_with_prefix(prefix, 'undefer',
+                                                  attribute(entity, name)))
+
+        # load_only on a subclass doesn't restrict what its
+        # selectin_polymorphic query selects, but defer does. In strict
+        # mode, every column we don't need is deferred with raiseload.
+        if local_names is not None:
+            column_names = local_names
+        elif strict and entity is not None:
+            column_names = mapper_index(entity).columns
+        else:
+            column_names = set()
+        if project_columns or strict:
+            defer_kwargs = {'raiseload': True} if strict else {}
+            unused = column_names - cfg['load_only'] - cfg['required']
+            for name in sorted(unused):
+                options.append(option_with_prefix(
+                    prefix, 'defer', attribute(entity, name), **defer_kwargs))
+
+    def extend_prefix(prefix, child_loader, name):
+        if prefix is not None:
+            new_prefix = getattr(prefix, child_loader)(name)
+        else:
+            new_prefix = getattr(orm, child_loader)(name)
+        return new_prefix
+
+    def option_with_prefix(prefix, method_name, *args, **kwargs):
+        if prefix is not None:
+            method = getattr(prefix, method_name)
+        else:
+            method = getattr(orm, method_name)
+        return method(*args, **kwargs)
+
+    def subtype_collector(cfg):
+        mapper = orm.class_mapper(entity_class(cls))
+        base_names = mapper_index(mapper).columns
+        subclasses = [mapper.polymorphic_map[identity].class_
+                      for identity in sorted(cfg['subtypes'])]
+        if root is not None:
+            options.append(root.selectin_polymorphic(subclasses))
+        else:
+            options.append(orm.selectin_polymorphic(cls, subclasses))
+        for subclass in subclasses:
+            subtype_mapper = orm.class_mapper(subclass)
+            local_names = mapper_index(subtype_mapper).columns - base_names
+            inner_collector(cfg['subtypes'][subtype_mapper.polymorphic_identity],
+                            orm.Load(subclass), (), subclass,
+                            local_names=local_names)
+
+    inner_collector(cfg, root, (), cls)
+    if cfg['subtypes']:
+        subtype_collector(cfg)
+    return options
+
+
+def attribute(entity, name):
+    """
+    the mapped attribute for name on entity, or just name without one
+    """
+    if entity is None:
+        return name
+    return getattr(entity, name)
@@ -0,0 +1,97 @@
+"""
+What the projection needs to know about a mapper, computed once per
+mapper per process rather than on every node of every config we build.
+
+mapper.relationships & mapper.column_attrs build a fresh collection
+each time they're read, and generating a config reads them (& turns
+them into sets) over & over at each level of nesting. Indexes are
+dropped whenever SQLAlchemy configures new mappers, since those can
+add relationships (backrefs) to the ones we've already indexed.
+"""
+from collections import namedtuple
+import threading
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+class LinkInfo(namedtuple('LinkInfo', ['name', 'target', 'uselist',
+                                       'direction', 'local_names'])):
+    """
+    a relationship: target is the class it points at & local_names the
+    (mapped names of the) columns on our side of it
+    """
+
+
+class MapperIndex(object):
+    """
+    columns & relationships are frozensets of attribute names, as are
+    key_names (the primary key plus the polymorphic discriminator) &
+    foreign_key_names. links is {relationship name: LinkInfo}.
+    """
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self.class_ = mapper.class_
+        self.columns = frozenset(mapper.column_attrs.keys())
+        self.links = {prop.key: LinkInfo(prop.key,
+                                         prop.mapper.class_,
+                                         prop.uselist,
+                                         prop.direction,
+                                         self.column_names(prop.local_columns))
+                      for prop in mapper.relationships}
+        self.relationships = frozenset(self.links)
+        key_columns = list(mapper.primary_key)
+        if mapper.polymorphic_on is not None:
+            key_columns.append(mapper.polymorphic_on)
+        self.key_names = self.column_names(key_columns)
+        self.foreign_key_names = frozenset(
+            prop.key for prop in mapper.column_attrs
+            if any(column.foreign_keys for column in prop.columns))
+        # {name: paths}, filled in by planner.descriptor_paths
+        self.descriptor_paths = {}
+
+    def column_names(self, columns):
+        """
+        mapped names of the given Columns; ones we don't map (like a
+        discriminator on a parent's table) are left out
+        """
+        names = set()
+        for column in columns:
+            try:
+                names.add(self.mapper.get_property_by_column(column).key)
+            except orm.exc.UnmappedColumnError:
+                pass
+        return frozenset(names)
+
+    def __repr__(self):
+        return '<MapperIndex {}: {} columns, {} links>'.format(
+            self.class_.__name__, len(self.columns), len(self.links))
+
+
+def mapper_index(entity):
+    """
+    the MapperIndex for a mapped class, aliased class or mapper
+    """
+    mapper = sa.inspect(entity).mapper
+    try:
+        return _indexes[mapper]
+    except KeyError:
+        pass
+    # NOTE: reading the mapper's properties configures pending mappers,
+    # which may clear _indexes; build first, then store.
+    index = MapperIndex(mapper)
+    with _lock:
+        return _indexes.setdefault(mapper, index)
+
+
+def clear_mapper_indexes():
+    with _lock:
+        _indexes.clear()
+
+
+@sa.event.listens_for(orm.Mapper, 'after_configured')
+def _mappers_configured():
+    clear_mapper_indexes()
@@ -0,0 +1,606 @@
+"""
+Builds projection config trees: which columns & links of a model a
+schema (plus its nested schemas) needs, level by level. See
+SchemaProjectionGenerator.config for the shape of the tree.
+"""
+import sqlalchemy as sa
+from sqlalchemy.ext.associationproxy import AssociationProxy
+from sqlalchemy.ext.hybrid import hybrid_property
+import sqlalchemy.orm as orm
+from sqlalchemy.sql import visitors
+
+from .loaders import get_next_class
+from .mapper_index import mapper_index
+from .schemas import (
+    dump_field_names,
+    ensure_instance,
+    freeze_path_tree,
+    get_next_schema,
+    merge_path_trees,
+    path_tree,
+    schema_key
+)
+
+
+def projection_config(schema_inst, cls, cache=None, dump_aware=False,
+                      only_paths=None, subtype_schemas=None, max_depth=None):
+    """
+    config tree for projecting cls with schema_inst, from cache if
+    possible. the returned tree may be shared, so don't mutate it.
+    """
+    return lookup_projection_config(schema_inst, cls, cache=cache,
+                                    dump_aware=dump_aware,
+                                    only_paths=only_paths,
+                                    subtype_schemas=subtype_schemas,
+                                    max_depth=max_depth)[0]
+
+
+def lookup_projection_config(schema_inst, cls, cache=None, dump_aware=False,
+                             only_paths=None, subtype_schemas=None,
+                             max_depth=None):
+    """
+    (config, cache hit) for projection_config; cache hit is None
+    without a cache.
+    """
+    def build():
+        return SchemaProjectionGenerator(schema_inst, cls,
+                                         filter_only_these=only_paths,
+                                         dump_aware=dump_aware,
+                                         subtype_schemas=subtype_schemas,
+                                         max_depth=max_depth).config
+
+    if cache is None:
+        return build(), None
+    key = projection_cache_key(schema_inst, cls, dump_aware=dump_aware,
+                               only_paths=only_paths,
+                               subtype_schemas=subtype_schemas,
+                               max_depth=max_depth)
+    return cache.lookup(key, build)
+
+
+def projection_cache_key(schema_inst, cls, dump_aware=False, only_paths=None,
+                         subtype_schemas=None, max_depth=None):
+    return (
+        schema_key(schema_inst),
+        orm.class_mapper(cls),
+        dump_aware,
+        freeze_path_tree(only_paths or {}),
+        frozenset((key, schema_key(subtype_schema)) for key, subtype_schema
+                  in (subtype_schemas or {}).items()),
+        max_depth,
+    )
+
+
+class SchemaProjectionGenerator(object):
+    """
+    schema_inst may be None when we are only fetching dependencies (see
+    dependency_tree) of a parent schema; with no dependencies either,
+    that means all columns.
+
+    Nested schemas can be cyclic (Nested('self'), or User.images ->
+    Image.user -> User.images...). Without max_depth, a link to a node
+    which repeats one of its ancestors is cut: it goes in the config's
+    'lazy' set rather than its childs, & is left to lazy loading. With
+    max_depth, links are loaded max_depth levels down & no further,
+    cycles or not.
+
+    Identical nodes (schema, mapper & what's asked of them) share one
+    config, through memo. Without max_depth, a subtree only depends on
+    which of its own nodes are on the stack above it, so we keep track
+    of the ancestors it was cut against (cuts) & the nodes it expanded
+    (expanded), & reuse it wherever those are the same; a subtree
+    without cuts is reused everywhere.
+    """
+    def __init__(self, schema_inst, query_cls, filter_only_these=None,
+                 dependencies=None, link_schemas=None, dump_aware=False,
+                 subtype_schemas=None, max_depth=None, depth=0,
+                 ancestors=(), memo=None):
+        self.schema = schema_inst
+        self.cls = query_cls
+        self.mapper = orm.class_mapper(query_cls)
+        self.index = mapper_index(self.mapper)
+        # path tree (see path_tree) of the schema fields to project;
+        # empty/None means all of them
+        self.filter_only_these = filter_only_these
+        self.dependencies = dependencies or {}
+        # dotted link path -> schema, for Nested fields with a dotted
+        # attribute like 'user.org'
+        self.link_schemas = link_schemas or {}
+        # only consider fields that are actually dumped (i.e. skip
+        # load_only ones)
+        self.dump_aware = dump_aware
+        # {subclass or polymorphic identity: schema}; see SchemaFilter
+        self.subtype_schemas = subtype_schemas or {}
+        self.max_depth = max_depth
+        # levels of links between the root & us
+        self.depth = depth
+        # node_keys from the root down to our parent
+        self.ancestors = ancestors
+        # for the whole tree being built: {(node_key, levels left):
+        # config} with max_depth, {node_key: [(config, cuts, expanded),
+        # ...]} without
+        self.memo = {} if memo is None else memo
+        self._node_key = None
+        # introspection of our schema, read for every link & field, so
+        # worked out once (see the properties of the same names)
+        self._schema_field_names = None
+        self._dependency_tree = None
+        self._all_link_schemas = None
+        # whether we're a repeat of an ancestor (see shared_config), the
+        # links of ours cut for that reason, the ancestors (above us)
+        # our subtree was cut against & the nodes it expanded
+        self.is_cut = False
+        self.cut_link_names = set()
+        self.cuts = set()
+        self.expanded = set()
+
+    @property
+    def node_key(self):
+        """
+        everything our config depends on, bar depth & ancestors
+        """
+        if self._node_key is None:
+            self._node_key = self.build_node_key()
+        return self._node_key
+
+    def build_node_key(self):
+        if self.schema is None:
+            node_schema = None
+        else:
+            node_schema = schema_key(self.schema)
+        return (
+            node_schema,
+            self.mapper,
+            freeze_path_tree(self.filter_only_these or {}),
+            freeze_path_tree(self.dependencies),
+            frozenset((path, schema_key(link_schema)) for path, link_schema
+                      in self.link_schemas.items()),
+            self.dump_aware,
+        )
+
+    def shared_config(self):
+        """
+        config, or the one already built for an identical node; None if
+        we'd close a cycle (see class docs), in which case is_cut is set.
+        """
+        node_key = self.node_key
+        if self.max_depth is not None:
+            memo_key = (node_key, self.max_depth - self.depth)
+            try:
+                return self.memo[memo_key]
+            except KeyError:
+                pass
+            cfg = self.memo[memo_key] = self.config
+            return cfg
+
+        stack = set(self.ancestors)
+        if node_key in stack:
+            self.is_cut = True
+            return None
+        variants = self.memo.setdefault(node_key, [])
+        for cfg, cuts, expanded in variants:
+            # the same ancestors are there to cut against & nothing we
+            # expanded would be cut this time
+            if cuts <= stack and stack.isdisjoint(expanded):
+                self.cuts, self.expanded = set(cuts), set(expanded)
+                return cfg
+        cfg = self.config
+        # cuts against ourselves happen wherever we're built
+        self.cuts.discard(node_key)
+        self.expanded.add(node_key)
+        variants.append((cfg, frozenset(self.cuts), frozenset(self.expanded)))
+        return cfg
+
+    def absorb(self, spg_obj, name=None):
+        """
+        takes in what building the config of spg_obj, our child (for
+        link name) or subtype, ran into
+        """
+        if spg_obj.is_cut:
+            self.cut_link_names.add(name)
+            self.cuts.add(spg_obj.node_key)
+        else:
+            self.cuts |= spg_obj.cuts
+            self.expanded |= spg_obj.expanded
+
+    def child(self, schema_inst, query_cls, **kwargs):
+        """
+        generator for a link of ours, one level down
+        """
+        return self.__class__(schema_inst, query_cls,
+                              dump_aware=self.dump_aware,
+                              max_depth=self.max_depth,
+                              depth=self.depth + 1,
+                              ancestors=self.ancestors + (self.node_key,),
+                              memo=self.memo,
+                              **kwargs)
+
+    @property
+    def config(self):
+        subtypes = self.subtype_configs()
+        childs = self.recurse_on_link_fields()
+        cfg = {
+            'reload': self.reload_field_names,
+            'load_only': (self.load_only_field_names |
+                          self.subtype_base_field_names(subtypes)),
+            'required': self.key_field_names,
+            'noload': self.noload_link_field_names,
+            'collections': self.collection_link_field_names,
+            'childs': childs,
+            # links cut by a cycle, to be lazy loaded
+            'lazy': set(self.cut_link_names),
+            'subtypes': subtypes,
+        }
+        return cfg
+
+    def subtype_configs(self):
+        """
+        {polymorphic identity: config} for the subclasses we have a
+        schema for
+        """
+        configs = {}
+        for key, subtype_schema in self.subtype_schemas.items():
+            subtype_mapper = self.subtype_mapper(key)
+            spg_obj = self.__class__(subtype_schema, subtype_mapper.class_,
+                                     dump_aware=self.dump_aware,
+                                     max_depth=self.max_depth,
+                                     depth=self.depth,
+                                     ancestors=(self.ancestors +
+                                                (self.node_key,)),
+                                     memo=self.memo)
+            configs[subtype_mapper.polymorphic_identity] = spg_obj.config
+            self.absorb(spg_obj)
+        return configs
+
+    def subtype_mapper(self, key):
+        if isinstance(key, type):
+            subtype_mapper = orm.class_mapper(key)
+        else:
+            subtype_mapper = self.mapper.polymorphic_map.get(key)
+        if subtype_mapper is None or not subtype_mapper.isa(self.mapper):
+            raise ValueError('not a subtype of {}:'.format(self.cls.__name__),
+                             key)
+        return subtype_mapper
+
+    def subtype_base_field_names(self, subtypes):
+        """
+        columns of cls the subtype schemas need; those come from the
+        base query, not the per-subclass ones.
+        """
+        names = set()
+        for subtype_cfg in subtypes.values():
+            names |= subtype_cfg['load_only'] | subtype_cfg['required']
+        return names & self.class_nonlink_field_names
+
+    def recurse_on_link_fields(self):
+        name_recursion_pairs = [(name, self.recurse_on_name(name))
+                                for name in self.link_field_names]
+        filtered_pairs = [(name, rec) for name, rec in name_recursion_pairs if rec]
+        ret = dict(filtered_pairs)
+        return ret
+
+    def recurse_on_name(self, name):
+        if self.max_depth is not None and self.depth >= self.max_depth:
+            return None
+        field_name = self.renamed_link_sources.get(name, name)
+        if field_name in self.schema_field_names:
+            next_schema = get_next_schema(self.schema, field_name)
+        else:
+            next_schema = self.all_link_schemas.get(name)
+        next_dependencies = self.dependency_tree.get(name)
+        next_link_schemas = {path.split('.', 1)[1]: schema
+                             for path, schema in self.all_link_schemas.items()
+                             if path.startswith(name + '.')}
+        next_class = get_next_class(self.mapper, name)
+        if next_class is None:
+            return None
+        elif next_schema is None and next_dependencies is None:
+            return None
+        elif next_schema is None:
+            spg_obj = self.child(None, next_class,
+                                 dependencies=next_dependencies,
+                                 link_schemas=next_link_schemas)
+        else:
+            if self.filter_only_these:
+                next_filter = self.filter_only_these.get(field_name)
+            else:
+                next_filter = None
+            spg_obj = self.child(ensure_instance(next_schema),
+                                 next_class,
+                                 filter_only_these=next_filter,
+                                 dependencies=next_dependencies,
+                                 link_schemas=next_link_schemas)
+        cfg = spg_obj.shared_config()
+        self.absorb(spg_obj, name)
+        return cfg
+
+    @property
+    def reload_field_names(self):
+        names = (self.class_link_field_names - self.noload_link_field_names)
+        return names
+
+    @property
+    def collection_link_field_names(self):
+        names = {name for name in self.reload_field_names
+                 if self.index.links[name].uselist}
+        return names
+
+    @property
+    def nonlink_field_names(self):
+        if self.schema is None and not self.dependency_tree:
+            return self.class_nonlink_field_names
+        names = (self.class_nonlink_field_names &
+                 (self.schema_field_names | self.dependency_field_names))
+        return names
+
+    @property
+    def noload_link_field_names(self):
+        names = self.basic_noload_link_field_names - self.renamed_attr_link_fields
+        return names
+
+    @property
+    def basic_noload_link_field_names(self):
+        names = (self.class_link_field_names - self.schema_field_names -
+                 self.dependency_field_names)
+        return names
+
+    @property
+    def load_only_field_names(self):
+        names = self.nonlink_field_names | self.renamed_attr_nonlink_fields
+        return names
+
+    @property
+    def key_field_names(self):
+        """
+        columns we need whether or not the schema mentions them: the
+        primary key (for identity), the polymorphic discriminator, and
+        the local side of every link we are going to load.
+        """
+        names = set(self.index.key_names)
+        for name in self.reload_field_names:
+            names |= self.index.links[name].local_names
+        return names
+
+    @property
+    def link_field_names(self):
+        names = ((self.schema_field_names | self.dependency_field_names |
+                  self.renamed_attr_link_fields) &
+                 self.class_link_field_names)
+        return names
+
+    @property
+    def class_link_field_names(self):
+        return self.index.relationships
+
+    @property
+    def class_nonlink_field_names(self):
+        return self.index.columns
+
+    @property
+    def schema_field_names(self):
+        if self._schema_field_names is None:
+            self._schema_field_names = frozenset(
+                self.build_schema_field_names())
+        return self._schema_field_names
+
+    def build_schema_field_names(self):
+        if self.schema is None:
+            return set()
+        elif self.dump_aware:
+            names = set(dump_field_names(self.schema))
+        else:
+            names = set(self.schema.fields.keys())
+        if self.filter_only_these:
+            names = {n for n in names if n in self.filter_only_these}
+        return names
+
+    @property
+    def dependency_tree(self):
+        """
+        Paths that have to be fetched for fields the schema can't tell
+        us about, e.g. a String field for a python property, declared
+        like
+
+            class Meta:
+                select_dependencies = {
+                    'full_name': ['first_name', 'last_name'],
+                    'org_label': ['org.name'],
+                }
+
+        as a tree: {'first_name': {}, 'last_name': {}, 'org': {'name': {}}}.
+        Fields that aren't in the schema (e.g. excluded) are ignored.
+        Also includes whatever the parent passed down as dependencies.
+        """
+        if self._dependency_tree is None:
+            self._dependency_tree = self.build_dependency_tree()
+        return self._dependency_tree
+
+    def build_dependency_tree(self):
+        tree = {}
+        declared = getattr(getattr(self.schema, 'Meta', None),
+                           'select_dependencies', {})
+        for field_name, paths in declared.items():
+            if field_name in self.schema_field_names:
+                merge_path_trees(tree, path_tree(paths))
+        for field_name in self.schema_field_names:
+            merge_path_trees(tree, path_tree(self.field_dependencies(field_name)))
+        merge_path_trees(tree, path_tree(self.all_link_schemas.keys()))
+        merge_path_trees(tree, self.dependencies)
+        return tree
+
+    def field_dependencies(self, name):
+        """
+        paths a single field needs beyond its own name: declared ones
+        for Method/Function & co, as in
+
+            Method('get_label',
+                   metadata={'select_dependencies': ['org.name']})
+
+        dotted attributes like String(attribute='org.name'), and what's
+        behind synonyms, hybrid properties & association proxies (see
+        descriptor_paths).
+        """
+        schema_field = self.schema.fields[name]
+        paths = list(schema_field.metadata.get('select_dependencies', ()))
+        if get_next_schema(self.schema, name) is None:
+            field_attr = schema_field.attribute or name
+            if '.' in field_attr:
+                paths.append(field_attr)
+            else:
+                paths.extend(descriptor_paths(self.mapper, field_attr))
+        return paths
+
+    @property
+    def all_link_schemas(self):
+        if self._all_link_schemas is None:
+            schemas = dict(self.link_schemas)
+            schemas.update(self.dotted_link_schemas())
+            schemas.update(self.descriptor_link_schemas())
+            self._all_link_schemas = schemas
+        return self._all_link_schemas
+
+    def dotted_link_schemas(self):
+        """
+        Nested fields with a dotted attribute, as {attribute: schema}
+        """
+        schemas = {}
+        for name in self.schema_field_names:
+            field_attr = self.schema.fields[name].attribute
+            if field_attr and '.' in field_attr:
+                next_schema = get_next_schema(self.schema, name)
+                if next_schema is not None:
+                    schemas[field_attr] = ensure_instance(next_schema)
+        return schemas
+
+    def descriptor_link_schemas(self):
+        """
+        Nested fields over an association proxy (or a synonym for a
+        relationship), as {path behind it: schema}
+        """
+        schemas = {}
+        for name in self.schema_field_names:
+            field_attr = self.schema.fields[name].attribute or name
+            next_schema = get_next_schema(self.schema, name)
+            if next_schema is None or '.' in field_attr:
+                continue
+            for path in descriptor_paths(self.mapper, field_attr):
+                schemas[path] = ensure_instance(next_schema)
+        return schemas
+
+    @property
+    def dependency_field_names(self):
+        return set(self.dependency_tree.keys())
+
+    @property
+    def unaccounted_for_field_names(self):
+        """
+        Most field names are either the names of direct fields or link
+        fields. There are some other cases which require special
+        processing,
+        """
+        names = ((self.schema_field_names - self.class_nonlink_field_names) -
+                 self.class_link_field_names)
+        return names
+
+    @property
+    def renamed_attr_link_fields(self):
+        names = [name for field_type, name in self.find_renamed_attr_fields()
+                 if field_type == 'link']
+        return set(names)
+
+    @property
+    def renamed_attr_nonlink_fields(self):
+        names = [name for field_type, name in self.find_renamed_attr_fields()
+                 if field_type == 'nonlink']
+        return set(names)
+
+    @property
+    def renamed_link_sources(self):
+        """
+        {link name: schema field name} for links the schema reads
+        through a differently-named field
+        """
+        sources = {}
+        for name in self.unaccounted_for_field_names:
+            field_type, field_attr = self.check_for_renamed_attr(name)
+            if field_type == 'link':
+                sources[field_attr] = name
+        return sources
+
+    def find_renamed_attr_fields(self):
+        result = [self.check_for_renamed_attr(name) for name
+                  in self.unaccounted_for_field_names]
+        renamed_fields = [(field_type, name) for field_type, name in result if name]
+        return renamed_fields
+
+    def check_for_renamed_attr(self, name):
+        schema_field = self.schema.fields[name]
+        field_attr = schema_field.attribute
+        # If there is no attr set in the schema class, this field is
+        # set to None
+        if not field_attr:
+            return False, None
+        elif field_attr in self.class_link_field_names:
+            return 'link', field_attr
+        elif field_attr in self.class_nonlink_field_names:
+            return 'nonlink', field_attr
+        else:
+            return False, None
+
+
+def descriptor_paths(mapper, name):
+    """
+    attribute paths behind name, when it's not a plain column or
+    relationship of mapper (or mapped class):
+
+    - a synonym: the attribute it stands for
+    - a hybrid property: the mapper's columns in its SQL expression
+      (which the python side presumably uses too)
+    - an association proxy: the relationship & the attribute on the
+      other end, e.g. 'user_keywords.keyword' for
+      association_proxy('user_keywords', 'keyword'), following proxies
+      to proxies
+
+    Anything else gives [].
+    """
+    index = mapper_index(mapper)
+    mapper = index.mapper
+    try:
+        return index.descriptor_paths[name]
+    except KeyError:
+        pass
+    descriptor = mapper.all_orm_descriptors.get(name)
+    if name in mapper.synonyms:
+        paths = [mapper.synonyms[name].name]
+    elif isinstance(descriptor, hybrid_property):
+        paths = hybrid_column_names(mapper, name)
+    elif isinstance(descriptor, AssociationProxy):
+        link = index.links.get(descriptor.target_collection)
+        if link is None:
+            paths = []
+        else:
+            value_paths = (descriptor_paths(link.target, descriptor.value_attr)
+                           or [descriptor.value_attr])
+            paths = ['{}.{}'.format(descriptor.target_collection, path)
+                     for path in value_paths]
+    else:
+        paths = []
+    index.descriptor_paths[name] = paths
+    return paths
+
+
+def hybrid_column_names(mapper, name):
+    try:
+        expression = getattr(mapper.class_, name).__clause_element__()
+    except Exception:
+        # python-only hybrids can blow up in all sorts of ways when
+        # called on the class
+        return []
+    names = set()
+    for element in visitors.iterate(expression, {}):
+        if isinstance(element, sa.Column):
+            try:
+                names.add(mapper.get_property_by_column(element).key)
+            except orm.exc.UnmappedColumnError:
+                pass
+    return sorted(names)
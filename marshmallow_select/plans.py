@@ -0,0 +1,335 @@
+"""
+Projection configs saved to a file as a build step & loaded into the
+cache when a worker boots, so no worker has to introspect schemas &
+mappers on its first requests.
+
+    # myapp/projections.py: the filters the app uses, with their models
+    FILTERS = [
+        (SchemaFilter(UserSchema(), unlazify=True), User),
+        (SchemaFilter(OrgSchema()), Org),
+    ]
+
+    # build step
+    python -m marshmallow_select.plans myapp.projections:FILTERS plans.json
+
+    # at boot
+    report = load_plans(FILTERS, 'plans.json')
+
+Plans are keyed by (a digest of) the key the cache uses, and carry a
+fingerprint of the schemas & mappers they were built from. Loading
+checks it against the live ones; plans that don't match (the code has
+changed since the file was built) are skipped, and get built the usual
+way on first use.
+"""
+import argparse
+from collections import namedtuple
+import hashlib
+import importlib
+import json
+
+from marshmallow import (
+    Schema,
+    class_registry
+)
+from marshmallow.fields import Nested
+import sqlalchemy.orm as orm
+
+from .loaders import entity_class
+from .mapper_index import mapper_index
+from .planner import projection_cache_key, projection_config
+from .schemas import unwrap_field
+
+FORMAT = 'marshmallow-select-plans'
+# bump whenever the file layout or the config tree changes
+# 2: 'lazy' (links cut by a cycle)
+VERSION = 2
+
+CONFIG_SETS = ('reload', 'load_only', 'required', 'noload', 'collections',
+               'lazy')
+
+
+class PlanLoadReport(namedtuple('PlanLoadReport',
+                                ['loaded', 'stale', 'missing'])):
+    """
+    names ('UserSchema on User') of the filters whose plan was loaded,
+    didn't match its fingerprint, or wasn't in the file at all
+    """
+    __slots__ = ()
+
+
+def export_plans(filters, path=None):
+    """
+    builds the config of each (SchemaFilter, model) in filters & returns
+    them as a JSON-able dict, which is also written to path if given
+    """
+    plans = {}
+    for schema_filter, model in filters:
+        cls = entity_class(model)
+        kwargs = schema_filter._config_kwargs()
+        key = projection_cache_key(schema_filter.schema_inst, cls, **kwargs)
+        cfg = projection_config(schema_filter.schema_inst, cls, **kwargs)
+        plans[key_digest(key)] = {
+            'schema': qualified_name(type(schema_filter.schema_inst)),
+            'model': qualified_name(cls),
+            'fingerprint': fingerprint(schema_filter, cls, cfg),
+            'config': dump_config(cfg),
+        }
+    data = {'format': FORMAT, 'version': VERSION, 'plans': plans}
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.write('\n')
+    return data
+
+
+def load_plans(filters, source, cache=None, verify=True):
+    """
+    puts the plans in source (a path, or export_plans' output) for
+    filters into cache, or each filter's own cache by default (filters
+    without one are skipped). A file of another format or version is
+    ignored as a whole. verify=False skips the fingerprint check, for
+    files built along with the code they're deployed with.
+    """
+    if isinstance(source, dict):
+        data = source
+    else:
+        with open(source) as f:
+            data = json.load(f)
+    if data.get('format') == FORMAT and data.get('version') == VERSION:
+        plans = data['plans']
+    else:
+        plans = {}
+
+    report = PlanLoadReport([], [], [])
+    for schema_filter, model in filters:
+        target = schema_filter.cache if cache is None else cache
+        if target is None:
+            continue
+        cls = entity_class(model)
+        name = '{} on {}'.format(type(schema_filter.schema_inst).__name__,
+                                 cls.__name__)
+        key = projection_cache_key(schema_filter.schema_inst, cls,
+                                   **schema_filter._config_kwargs())
+        plan = plans.get(key_digest(key))
+        if plan is None:
+            report.missing.append(name)
+            continue
+        cfg = load_config(plan['config'])
+        if verify and fingerprint(schema_filter, cls, cfg) != plan['fingerprint']:
+            report.stale.append(name)
+            continue
+        target.put(key, cfg)
+        report.loaded.append(name)
+    return report
+
+
+def dump_config(cfg):
+    """
+    config tree as JSON-able {'root': index, 'nodes': [...]}. Subtrees
+    shared within the tree (see SchemaProjectionGenerator) are stored
+    once; nodes come after the ones they point to.
+    """
+    nodes = []
+    indexes = {}
+
+    def add(cfg):
+        try:
+            return indexes[id(cfg)]
+        except KeyError:
+            pass
+        node = {name: sorted(cfg[name]) for name in CONFIG_SETS}
+        node['childs'] = {name: add(child_cfg)
+                          for name, child_cfg in cfg['childs'].items()}
+        node['subtypes'] = [[identity, add(subtype_cfg)]
+                            for identity, subtype_cfg
+                            in sorted(cfg['subtypes'].items(),
+                                      key=lambda item: repr(item[0]))]
+        indexes[id(cfg)] = len(nodes)
+        nodes.append(node)
+        return indexes[id(cfg)]
+
+    return {'root': add(cfg), 'nodes': nodes}
+
+
+def load_config(data):
+    configs = []
+    for node in data['nodes']:
+        cfg = {name: set(node[name]) for name in CONFIG_SETS}
+        cfg['childs'] = {name: configs[index]
+                         for name, index in node['childs'].items()}
+        cfg['subtypes'] = {identity: configs[index]
+                           for identity, index in node['subtypes']}
+        configs.append(cfg)
+    return configs[data['root']]
+
+
+def fingerprint(schema_filter, cls, cfg):
+    """
+    digest of what cfg was built from: every schema class reachable
+    from the filter's schemas, and the mappers along cfg
+    """
+    schemas = [schema_filter.schema_inst]
+    schemas.extend(schema_filter.subtype_schemas.values())
+    return digest([schema_description({type(schema) for schema in schemas}),
+                   mapper_description(cls, cfg)])
+
+
+def schema_description(schema_classes):
+    descriptions = {}
+    todo = list(schema_classes)
+    while todo:
+        schema_cls = todo.pop()
+        name = qualified_name(schema_cls)
+        if name not in descriptions:
+            description, nested_classes = describe_schema_class(schema_cls)
+            descriptions[name] = description
+            todo.extend(nested_classes)
+    return descriptions
+
+
+_schema_class_descriptions = {}
+
+
+def describe_schema_class(schema_cls):
+    """
+    (description, nested schema classes) for a schema class, from its
+    declared fields & options. Goes by the class rather than an
+    instance, since instantiating every schema would cost about as much
+    as the introspection we're trying to skip.
+    """
+    try:
+        return _schema_class_descriptions[schema_cls]
+    except KeyError:
+        pass
+    fields = []
+    nested_classes = []
+    declared_fields = schema_cls._declared_fields
+    for field_name, schema_field in sorted(declared_fields.items()):
+        inner = unwrap_field(schema_field)
+        if isinstance(inner, Nested):
+            nested_cls = declared_nested_class(schema_cls, inner.nested)
+            if nested_cls is not None:
+                nested_classes.append(nested_cls)
+            nested = [plain(nested_cls),
+                      plain(inner.only),
+                      plain(inner.exclude)]
+        else:
+            nested = None
+        fields.append([
+            field_name,
+            type(schema_field).__name__,
+            schema_field.attribute,
+            schema_field.load_only,
+            plain(schema_field.metadata.get('select_dependencies')),
+            nested,
+        ])
+    meta = getattr(schema_cls, 'Meta', None)
+    options = [plain(getattr(schema_cls.opts, name, None))
+               for name in ('fields', 'additional', 'exclude', 'load_only')]
+    declared = plain(getattr(meta, 'select_dependencies', {}))
+    result = [fields, options, declared], nested_classes
+    _schema_class_descriptions[schema_cls] = result
+    return result
+
+
+def declared_nested_class(schema_cls, nested):
+    """
+    the schema class a Nested field was declared with, however it was
+    given; None for a dict of fields
+    """
+    if callable(nested) and not isinstance(nested, type):
+        nested = nested()
+    if isinstance(nested, Schema):
+        return type(nested)
+    elif isinstance(nested, type):
+        return nested
+    elif nested == 'self':
+        return schema_cls
+    elif isinstance(nested, str):
+        return class_registry.get_class(nested)
+    return None
+
+
+def mapper_description(cls, cfg):
+    descriptions = {}
+    missing = []
+    seen = set()
+
+    def walk(cfg, cls):
+        if (id(cfg), cls) in seen:
+            return
+        seen.add((id(cfg), cls))
+        index = mapper_index(cls)
+        descriptions[qualified_name(cls)] = [
+            sorted(index.columns),
+            sorted([link.name, qualified_name(link.target), link.uselist]
+                   for link in index.links.values()),
+            sorted(index.key_names),
+            sorted(index.mapper.all_orm_descriptors.keys()),
+        ]
+        for name, child_cfg in cfg['childs'].items():
+            link = index.links.get(name)
+            if link is None:
+                missing.append([qualified_name(cls), name])
+            else:
+                walk(child_cfg, link.target)
+        for identity, subtype_cfg in cfg['subtypes'].items():
+            subtype_mapper = index.mapper.polymorphic_map.get(identity)
+            if subtype_mapper is None:
+                missing.append([qualified_name(cls), identity])
+            else:
+                walk(subtype_cfg, subtype_mapper.class_)
+
+    walk(cfg, cls)
+    return [descriptions, sorted(missing, key=repr)]
+
+
+def key_digest(key):
+    return digest(plain(key))
+
+
+def digest(value):
+    text = json.dumps(value, sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def plain(value):
+    """
+    JSON-able (& stable) version of a cache key or part of one
+    """
+    if isinstance(value, (set, frozenset)):
+        return sorted((plain(item) for item in value),
+                      key=lambda item: json.dumps(item, sort_keys=True,
+                                                  default=repr))
+    elif isinstance(value, (tuple, list)):
+        return [plain(item) for item in value]
+    elif isinstance(value, dict):
+        return {str(k): plain(v) for k, v in value.items()}
+    elif isinstance(value, type):
+        return qualified_name(value)
+    elif isinstance(value, orm.Mapper):
+        return qualified_name(value.class_)
+    return value
+
+
+def qualified_name(cls):
+    return '{}.{}'.format(cls.__module__, cls.__qualname__)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='write projection plans for load_plans')
+    parser.add_argument('filters',
+                        help='module:attribute naming a list of '
+                             '(SchemaFilter, model) pairs')
+    parser.add_argument('output', help='file to write (JSON)')
+    args = parser.parse_args(argv)
+
+    module_name, _, attribute = args.filters.partition(':')
+    filters = getattr(importlib.import_module(module_name), attribute)
+    data = export_plans(filters, args.output)
+    print('wrote {} plans to {}'.format(len(data['plans']), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+pytest helpers for keeping query counts down.
+
+    def test_user_list(assert_max_queries, session):
+        qry = SchemaFilter(UserSchema(), strategy='auto')(session.query(User))
+        with assert_max_queries(3):
+            UserSchema(many=True).dump(qry.all())
+
+    @pytest.mark.max_queries(3)
+    def test_user_list_again(session):
+        ...
+
+Both count statements on every engine unless given a session/bind.
+Enable it in a conftest.py with
+
+    pytest_plugins = ['marshmallow_select.pytest_plugin']
+
+It needs pytest>=3.6 & pluggy>=1.1 (marshmallow-select[pytest]).
+"""
+from contextlib import contextmanager
+
+import pytest
+
+from .coverage import QueryRecorder
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers',
+        'max_queries(n): fail if the test body issues more than n queries')
+
+
+def format_query_budget(queries, budget):
+    """
+    numbered statements, with the ones over budget marked with a '+'
+    """
+    lines = ['expected at most {} queries, got {}:'.format(budget,
+                                                           len(queries))]
+    for i, query in enumerate(queries, 1):
+        marker = '+' if i > budget else ' '
+        text = str(query).replace('\n', '\n     ')
+        lines.append('{} {}. {}'.format(marker, i, text))
+    return '\n'.join(lines)
+
+
+@contextmanager
+def max_queries(budget, session=None, bind=None):
+    with QueryRecorder(session=session, bind=bind) as recorder:
+        yield recorder
+    if len(recorder.queries) > budget:
+        pytest.fail(format_query_budget(recorder.queries, budget),
+                    pytrace=False)
+
+
+@pytest.fixture
+def assert_max_queries():
+    return max_queries
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    marker = item.get_closest_marker('max_queries')
+    if marker is None:
+        yield
+        return
+
+    budget = marker.args[0] if marker.args else marker.kwargs['n']
+    with QueryRecorder() as recorder:
+        outcome = yield
+
+    if outcome.excinfo is None and len(recorder.queries) > budget:
+        outcome.force_exception(pytest.fail.Exception(
+            format_query_budget(recorder.queries, budget), pytrace=False))
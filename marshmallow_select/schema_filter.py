@@ -1,237 +1,368 @@
-from marshmallow import Schema
-from marshmallow.fields import (
-    List,
-    Nested
-)
+import itertools
+from time import perf_counter
+
+import sqlalchemy as sa
 import sqlalchemy.orm as orm
 
+from .cache import ProjectionCache
+from .loaders import (
+    LoaderStrategy,
+    ProjectionPlan,
+    collect_loader_options,
+    entity_class
+)
+from .planner import lookup_projection_config
+from .schemas import (
+    ensure_instance,
+    field_path_tree,
+    schema_for_fields,
+    tree_paths
+)
+from .stats import ProjectionStats, config_shape
+
+# so the older marshmallow_select.schema_filter.<name> imports keep working
+from .loaders import get_next_class, project_query  # noqa: F401
+from .planner import SchemaProjectionGenerator  # noqa: F401
+from .schemas import get_next_schema  # noqa: F401
+
+
+projection_cache = ProjectionCache()
+
 
 class SchemaFilter(object):
-    def __init__(self, schema, unlazify=False):
+    def __init__(self, schema, unlazify=False, cache=True,
+                 project_columns=False, strategy=None, path_loaders=None,
+                 reuse_joins=False, dump_aware=False, subtype_schemas=None,
+                 raiseload=False, strict=False, observer=None,
+                 max_depth=None):
         if isinstance(schema, type):
             self.schema_inst = schema()
         else:
             self.schema_inst = schema
 
-        if unlazify:
-            self.loader = orm.joinedload
+        # strategy='auto' joinedloads to-one links & selectinloads
+        # collections (joining several sibling collections multiplies
+        # rows). path_loaders overrides it per dotted path, e.g.
+        # {'likes.image': 'subqueryload'}.
+        if strategy == 'auto':
+            self.loader = LoaderStrategy('joinedload',
+                                         collections='selectinload',
+                                         overrides=path_loaders)
+        elif strategy:
+            self.loader = LoaderStrategy(strategy, overrides=path_loaders)
+        elif unlazify:
+            self.loader = LoaderStrategy('joinedload', overrides=path_loaders)
+        else:
+            self.loader = LoaderStrategy('defaultload', overrides=path_loaders)
+
+        # By default we only undefer the schema's columns, so anything
+        # not deferred on the mapper still gets selected. With
+        # project_columns we load_only the schema's columns (plus keys)
+        # at every level instead.
+        self.project_columns = project_columns
+
+        # With reuse_joins, links the query already joins along (like
+        # qry.join(User.images)) are populated from that join with
+        # contains_eager rather than joined a second time. Note that if
+        # the query filters on the joined table, so will the
+        # collections, and a LIMIT (like .first()) cuts them short.
+        self.reuse_joins = reuse_joins
+
+        # By default every field on the schema gets fetched, even
+        # load_only ones (see README). With dump_aware only fields that
+        # actually get dumped are.
+        self.dump_aware = dump_aware
+
+        # Relationships outside the projection are noload-ed, i.e. they
+        # quietly come back empty. With raiseload they raise when
+        # accessed instead, so a schema that needs more than we
+        # projected fails loudly (under asyncio, the lazy load would
+        # fail anyway, just less helpfully).
+        self.raiseload = raiseload
+
+        # strict goes further: columns outside the projection are
+        # deferred with raiseload too, so anything that would take
+        # another query raises (needs SQLAlchemy 1.4). Meant for proving
+        # endpoints are single-pass in tests/staging.
+        self.strict = strict
+
+        # path tree restricting which schema fields get projected; see
+        # for_fields
+        self.only_paths = None
+
+        # For polymorphic models: {subclass (or its polymorphic
+        # identity): schema}, the way a OneOfSchema dispatches on type.
+        # Rows of those subclasses get their own table loaded with
+        # selectin_polymorphic (one query per subclass, not per row),
+        # projected with their schema.
+        self.subtype_schemas = {key: ensure_instance(subtype_schema)
+                                for key, subtype_schema
+                                in (subtype_schemas or {}).items()}
+
+        # how many levels of links to load at most. Needed to load
+        # anything through a cyclic schema (e.g. Nested('self') for a
+        # tree) past the first repeat; see SchemaProjectionGenerator.
+        self.max_depth = max_depth
+
+        # called with a ProjectionStats (see stats) every time we
+        # project something, e.g. to send to your metrics system
+        self.observer = observer
+
+        # cache=True means the module-level projection_cache; pass a
+        # ProjectionCache to use your own, or False to always rebuild.
+        if cache is True:
+            self.cache = projection_cache
+        elif cache is False:
+            self.cache = None
         else:
-            self.loader = orm.defaultload
+            self.cache = cache
 
     def __call__(self, qry, cls=None):
+        return self._apply(qry, cls, self.loader)
+
+    def stream(self, qry, chunk_size=1000, schema=None):
+        """
+        Generator of dumped dicts for qry, chunk_size rows at a time,
+        for result sets too big to hold in memory at once. Rows come in
+        with yield_per; collections are selectinloaded per chunk (joined
+        ones don't work with yield_per) & to-one links are joined. Each
+        chunk is dumped, then its objects are expunged from the session.
+
+        Chunks are dumped with schema if given, else with ours (limited
+        to the paths we were made for, see for_fields).
+        """
+        if schema is None:
+            schema = self.dump_schema()
+        qry = self._apply(qry, None, self.loader.streaming())
+        session = qry.session
+        rows = iter(qry.yield_per(chunk_size))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            result = schema.dump(chunk, many=True)
+            data = getattr(result, 'data', result)
+            for obj in chunk:
+                if obj in session:
+                    session.expunge(obj)
+            del chunk
+            for item in data:
+                yield item
+
+    def dump_schema(self):
+        """
+        schema dumping what we project: ours, or with only_paths (see
+        for_fields), the schema_for_fields matching them
+        """
+        if not self.only_paths:
+            return self.schema_inst
+        return schema_for_fields(type(self.schema_inst),
+                                 tree_paths(self.only_paths))
+
+    def _apply(self, qry, cls, loader):
         if not cls:
-            cls = qry._entity_zero().class_
+            cls = query_entity(qry)
 
-        projector = SchemaProjectionGenerator(self.schema_inst, cls)
-        projection_cfg = projector.config
+        # with several entities in the query, unbound options would be
+        # ambiguous, so hang them off the one we're projecting.
+        if len(qry.column_descriptions) > 1:
+            root = orm.Load(cls)
+        else:
+            root = None
 
-        new_qry = project_query(qry, projection_cfg, loader=self.loader)
-        return new_qry
+        if self.reuse_joins:
+            joined_paths = query_joined_paths(qry, cls)
+        else:
+            joined_paths = ()
 
+        return self._project(cls, root, joined_paths, loader, qry=qry)
 
-class SchemaProjectionGenerator(object):
-    def __init__(self, schema_inst, query_cls, filter_only_these=None):
-        self.schema = schema_inst
-        self.cls = query_cls
-        self.mapper = orm.class_mapper(query_cls)
-        self.filter_only_these = filter_only_these
+    def loader_options(self, cls, root=None, joined_paths=()):
+        return self._project(cls, root, joined_paths, self.loader)
 
-    @property
-    def config(self):
-        cfg = {
-            'reload': self.reload_field_names,
-            'load_only': self.load_only_field_names,
-            'noload': self.noload_link_field_names,
-            'childs': self.recurse_on_link_fields()
+    def _project(self, cls, root, joined_paths, loader, qry=None):
+        """
+        loader options for cls, applied to qry if there is one; either
+        way, tells the observer how it went.
+        """
+        start = perf_counter()
+        projection_cfg, cache_hit = lookup_projection_config(
+            self.schema_inst, entity_class(cls), cache=self.cache,
+            **self._config_kwargs())
+        configured = perf_counter()
+
+        options = collect_loader_options(projection_cfg, loader=loader,
+                                         project_columns=self.project_columns,
+                                         root=root, joined_paths=joined_paths,
+                                         cls=cls, raiseload=self.raiseload,
+                                         strict=self.strict)
+        result = options if qry is None else qry.options(*options)
+
+        if self.observer is not None:
+            depth, columns, relationships = config_shape(
+                projection_cfg, loader=loader,
+                project_columns=self.project_columns,
+                joined_paths=joined_paths)
+            self.observer(ProjectionStats(
+                schema=type(self.schema_inst).__name__,
+                model=entity_class(cls).__name__,
+                cache_hit=cache_hit,
+                introspection_time=configured - start,
+                options_time=perf_counter() - configured,
+                depth=depth,
+                options=len(options),
+                columns=columns,
+                relationships=relationships,
+            ))
+        return result
+
+    def _config_kwargs(self):
+        """
+        what (besides schema & model) the config depends on, as
+        keyword args for projection_config & projection_cache_key
+        """
+        return {
+            'dump_aware': self.dump_aware,
+            'only_paths': self.only_paths,
+            'subtype_schemas': self.subtype_schemas,
+            'max_depth': self.max_depth,
         }
-        return cfg
-
-    def recurse_on_link_fields(self):
-        name_recursion_pairs = [(name, self.recurse_on_name(name))
-                                for name in self.link_field_names]
-        filtered_pairs = [(name, rec) for name, rec in name_recursion_pairs if rec]
-        ret = dict(filtered_pairs)
-        return ret
-
-    def recurse_on_name(self, name):
-        cls = self.__class__
-        next_schema = get_next_schema(self.schema, name)
-        next_class = get_next_class(self.mapper, name)
-        if next_schema is None or next_class is None:
-            return None
-        else:
-            spg_obj = cls(ensure_instance(next_schema),
-                          next_class)
-            return spg_obj.config
-
-    @property
-    def reload_field_names(self):
-        names = (self.class_link_field_names - self.noload_link_field_names)
-        return names
-
-    @property
-    def nonlink_field_names(self):
-        names = (self.class_nonlink_field_names & self.schema_field_names)
-        return names
-
-    @property
-    def noload_link_field_names(self):
-        names = self.basic_noload_link_field_names | self.renamed_attr_link_fields
-        return names
-
-    @property
-    def basic_noload_link_field_names(self):
-        names = (self.class_link_field_names - self.schema_field_names)
-        return names
-
-    @property
-    def load_only_field_names(self):
-        names = self.nonlink_field_names | self.renamed_attr_nonlink_fields
-        return names
-
-    @property
-    def link_field_names(self):
-        names = (self.schema_field_names & self.class_link_field_names)
-        if self.filter_only_these:
-            names = {n for n in names if n in self.filter_only_these}
-        return names
-
-    @property
-    def class_link_field_names(self):
-        class_names = set(self.mapper.relationships.keys())
-        return class_names
-
-    @property
-    def class_nonlink_field_names(self):
-        class_names = set(self.mapper.column_attrs.keys())
-        return class_names
-
-    @property
-    def schema_field_names(self):
-        return set(self.schema.fields.keys())
-
-    @property
-    def unaccounted_for_field_names(self):
+
+    def compile(self, cls):
         """
-        Most field names are either the names of direct fields or link
-        fields. There are some other cases which require special
-        processing,
+        do all the introspection now (e.g. at app boot) & return a
+        ProjectionPlan which just has to be applied to the query later.
         """
-        names = ((self.schema_field_names - self.class_nonlink_field_names) -
-                 self.class_link_field_names)
-        return names
-
-    @property
-    def renamed_attr_link_fields(self):
-        names = [name for field_type, name in self.find_renamed_attr_fields()
-                 if field_type == 'link']
-        return set(names)
-
-    @property
-    def renamed_attr_nonlink_fields(self):
-        names = [name for field_type, name in self.find_renamed_attr_fields()
-                 if field_type == 'nonlink']
-        return set(names)
-
-    def find_renamed_attr_fields(self):
-        result = [self.check_for_renamed_attr(name) for name
-                  in self.unaccounted_for_field_names]
-        renamed_fields = [(field_type, name) for field_type, name in result if name]
-        return renamed_fields
-
-    def check_for_renamed_attr(self, name):
-        schema_field = self.schema.fields[name]
-        field_attr = schema_field.attribute
-        # If there is no attr set in the schema class, this field is
-        # set to None
-        if not field_attr:
-            return False, None
-        elif field_attr in self.class_link_field_names:
-            return 'link', field_attr
-        elif field_attr in self.class_nonlink_field_names:
-            return 'nonlink', field_attr
-        else:
-            return False, None
+        return ProjectionPlan(cls, self.loader_options(cls))
 
+    def to_select(self, model):
+        """
+        SelectPlan (see core) fetching model straight into dicts shaped
+        like the schema's dump, without the ORM.
+        """
+        from .core import SelectPlan
+        cfg, _ = lookup_projection_config(self.schema_inst, entity_class(model),
+                                          cache=self.cache,
+                                          **self._config_kwargs())
+        return SelectPlan(self.schema_inst, model, cfg,
+                          only_paths=self.only_paths)
+
+    @classmethod
+    def for_fields(cls, schema, paths, **filter_kwargs):
+        """
+        SchemaFilter projecting only the given dotted field paths of
+        schema, e.g. from ?fields=id,name,org.name,images.url. A path
+        to a nested field without anything after it means all of it.
+        Raises InvalidFieldPath for paths the schema doesn't have.
 
-def get_next_schema(schema, name):
-    field = schema.fields[name]
-    if type(field) is List and type(field.container) is not Nested:
-        return None
-    elif type(field) is List:
-        return field.container.nested
-    elif type(field) is Nested:
-        return field.nested
-    else:
-        return None
+        Dump with schema_for_fields(schema, paths) to match.
+        """
+        schema_inst = ensure_instance(schema)
+        only_paths = field_path_tree(type(schema_inst), paths)
+        sf = cls(schema_inst, **filter_kwargs)
+        sf.only_paths = only_paths
+        return sf
 
 
-def get_next_class(mapper, name):
-    return mapper.relationships[name].mapper.class_
+class MultiSchemaFilter(object):
+    """
+    Projects every entity of a multi-entity query, e.g.
 
+        sf = MultiSchemaFilter({User: UserSchema(), Org: OrgSchema()})
+        qry = sf(session.query(User, Org).join(Org, User.org_id == Org.id))
 
-def ensure_instance(schema):
+    schemas is keyed by entity (a mapped class or an aliased() one).
+    Entities without a schema are left alone. Any other keyword args
+    go to the SchemaFilter built for each entity.
     """
-    various methods expect instances of schema, but sometimes
-    introspections yield classes (not totally sure why). but we can't
-    just blindly call ProbablyAClass() without sometimes getting
-    not-callable errors.
+    def __init__(self, schemas, **filter_kwargs):
+        self.filters = {entity: SchemaFilter(schema, **filter_kwargs)
+                        for entity, schema in schemas.items()}
+
+    def __call__(self, qry):
+        options = []
+        for entity in query_entities(qry):
+            schema_filter = (self.filters.get(entity) or
+                             self.filters.get(entity_class(entity)))
+            if schema_filter is None:
+                continue
+            if schema_filter.reuse_joins:
+                joined_paths = query_joined_paths(qry, entity)
+            else:
+                joined_paths = ()
+            options.extend(schema_filter.loader_options(
+                entity, root=orm.Load(entity), joined_paths=joined_paths))
+        return qry.options(*options)
+
+
+def precompile(schema, model, unlazify=False, **filter_kwargs):
     """
-    if isinstance(schema, Schema):
-        return schema
-    # TODO(dmr, 2017-06-07): confirm that is of type
-    # schema-class-thing so errors are more localized
-    elif isinstance(schema, type):
-        return schema()
-    else:
-        raise ValueError('lolwut:', schema)
+    precompile(UserSchema, User, unlazify=True) is short for
+    SchemaFilter(UserSchema, unlazify=True).compile(User); other
+    keyword args go to SchemaFilter too.
+    """
+    sf = SchemaFilter(schema, unlazify=unlazify, **filter_kwargs)
+    return sf.compile(model)
 
 
-def project_query(qry, cfg, loader):
+def query_entity(qry):
     """
-    BFSs through config tree modifying query
+    the class of the first entity in the query, which may be a Query
+    or a 1.4+ select()
     """
-    def inner_projector(qry, cfg, prefix):
-        """
-        prefix is the path constructed by applying a series of load
-        strategies, as in
+    return qry.column_descriptions[0]['entity']
 
-        qry.options(joinedload('foo').
-                    joinedload('bar').
-                    joinedload('baz'))
 
-        or None if we are at the root.
-        """
-        load_only_names = cfg['load_only']
-
-        qry = apply_with_prefix(qry, prefix, 'noload', '*')
-
-        for name, child_cfg in cfg['childs'].items():
-            qry = project_child(qry, child_cfg, prefix, name)
-
-        for name in load_only_names:
-            qry = apply_with_prefix(qry, prefix, 'undefer', name)
-        return qry
+def query_entities(qry):
+    """
+    the entities (classes or aliases) selected in full by the query,
+    skipping plain columns like User.id.
+    """
+    return [desc['entity'] for desc in qry.column_descriptions
+            if desc['entity'] is not None and desc['expr'] is desc['entity']]
 
-    def project_child(qry, cfg, prefix, name):
-        new_prefix = extend_prefix(prefix, name)
-        return inner_projector(qry, cfg, new_prefix)
 
-    def extend_prefix(prefix, name):
-        if prefix:
-            new_prefix = getattr(prefix, loader.__name__)(name)
-        else:
-            new_prefix = loader(name)
-        return new_prefix
+def query_joined_paths(qry, entity):
+    """
+    dotted relationship paths from entity that the query already joins
+    along, e.g. {'likes', 'likes.image'} for
 
-    def apply_with_prefix(qry, prefix, method_name, arg):
-        if prefix:
-            method = getattr(prefix, method_name)
-            new_qry = qry.options(method(arg))
-        else:
-            method = getattr(orm, method_name)
-            new_qry = qry.options(method(arg))
-        return new_qry
+        qry.join(User.likes).join(Like.image)
 
-    new_qry = inner_projector(qry, cfg, None)
-    return new_qry
+    Works for Query & select(). Only plain (non-aliased) joins along
+    relationship attributes are found. Needs SQLAlchemy 1.4; on older
+    versions nothing is found.
+    """
+    # Query keeps its joins in _legacy_setup_joins, select() in
+    # _setup_joins (with an empty _legacy_setup_joins)
+    setup_joins = (getattr(qry, '_legacy_setup_joins', None) or
+                   getattr(qry, '_setup_joins', ()))
+
+    class_paths = {entity_class(entity): ()}
+    joined_paths = set()
+    for join in setup_joins:
+        target, onclause, flags = join[0], join[1], join[-1]
+        if flags.get('aliased'):
+            continue
+        prop = _relationship_of(onclause) or _relationship_of(target)
+        target_info = sa.inspect(target, raiseerr=False)
+        if prop is None or getattr(target_info, 'is_aliased_class', False):
+            continue
+        parent_path = class_paths.get(prop.parent.class_)
+        if parent_path is None:
+            continue
+        path = parent_path + (prop.key,)
+        joined_paths.add('.'.join(path))
+        class_paths.setdefault(prop.mapper.class_, path)
+    return joined_paths
+
+
+def _relationship_of(thing):
+    # of_type() joins go to an alias, which we can't contains_eager
+    # without knowing about it
+    if getattr(thing, '_of_type', None) is not None:
+        return None
+    prop = getattr(thing, 'property', None)
+    if isinstance(prop, orm.RelationshipProperty):
+        return prop
+    return None
@@ -0,0 +1,221 @@
+"""
+The marshmallow side of projecting: walking schemas, their (nested)
+fields & dotted field paths. Nothing here needs SQLAlchemy.
+"""
+from marshmallow import Schema
+from marshmallow.fields import (
+    List,
+    Nested
+)
+
+
+class InvalidFieldPath(ValueError):
+    pass
+
+
+def schema_for_fields(schema_cls, paths, **schema_kwargs):
+    """
+    schema_cls(only=...) matching SchemaFilter.for_fields(schema_cls,
+    paths)
+    """
+    return schema_cls(only=only_for_fields(schema_cls, paths),
+                      **schema_kwargs)
+
+
+def only_for_fields(schema_cls, paths):
+    """
+    validated paths, as a tuple suitable for a schema's only
+    """
+    field_path_tree(schema_cls, paths)
+    return tuple(sorted(set(paths)))
+
+
+def field_path_tree(schema_cls, paths):
+    """
+    path_tree(paths), after checking every path exists on schema_cls
+    """
+    tree = path_tree(paths)
+    _validate_path_tree(schema_cls, tree, ())
+    return tree
+
+
+def _validate_path_tree(schema_cls, tree, prefix):
+    index = schema_field_index(schema_cls)
+    for name, subtree in tree.items():
+        path = prefix + (name,)
+        if name not in index:
+            raise InvalidFieldPath('unknown field: ' + '.'.join(path))
+        elif subtree and index[name] is None:
+            raise InvalidFieldPath('not a nested field: ' + '.'.join(path))
+        elif subtree:
+            _validate_path_tree(nested_schema_class(schema_cls, name),
+                                subtree, path)
+
+
+_schema_field_indexes = {}
+_nested_schema_classes = {}
+
+
+def schema_field_index(schema_cls):
+    """
+    {field name: the (unwrapped) Nested field, or None if not nested},
+    built once per schema class. Together with nested_schema_class these
+    make a lazily-built trie of a schema's valid field paths, so we
+    never walk (possibly recursive) schemas further than asked to.
+    """
+    try:
+        return _schema_field_indexes[schema_cls]
+    except KeyError:
+        pass
+    index = {}
+    for name, field in schema_cls().fields.items():
+        field = unwrap_field(field)
+        index[name] = field if isinstance(field, Nested) else None
+    _schema_field_indexes[schema_cls] = index
+    return index
+
+
+def nested_schema_class(schema_cls, name):
+    key = (schema_cls, name)
+    try:
+        return _nested_schema_classes[key]
+    except KeyError:
+        pass
+    nested_cls = type(schema_field_index(schema_cls)[name].schema)
+    _nested_schema_classes[key] = nested_cls
+    return nested_cls
+
+
+def schema_key(schema_inst):
+    # the field names catch schemas which pick their fields based on
+    # context or the like, rather than through only/exclude.
+    return (
+        type(schema_inst),
+        _option_key(schema_inst.only),
+        _option_key(schema_inst.exclude),
+        _option_key(schema_inst.load_only),
+        frozenset(schema_inst.fields),
+        _nested_options_key(schema_inst),
+    )
+
+
+def _option_key(names):
+    if names is None:
+        return None
+    elif isinstance(names, str):
+        return frozenset([names])
+    return frozenset(names)
+
+
+def _nested_options_key(schema_inst):
+    """
+    only/exclude of each Nested field. marshmallow 3 moves dotted
+    names ('likes.image') off schema.only & onto the nested fields,
+    still dotted for the levels below, so this covers every level
+    without instantiating the nested schemas.
+    """
+    options = []
+    for name, schema_field in schema_inst.fields.items():
+        field = unwrap_field(schema_field)
+        if isinstance(field, Nested):
+            options.append((name,
+                            _option_key(field.only),
+                            _option_key(field.exclude)))
+    return frozenset(options)
+
+
+def get_next_schema(schema, name):
+    """
+    the nested schema instance for the field, with the field's (and
+    any dotted instance-level) only/exclude applied; for Pluck, that's
+    just the plucked field.
+    """
+    field = unwrap_field(schema.fields[name])
+    if isinstance(field, Nested):
+        return field.schema
+    else:
+        return None
+
+
+def dump_field_names(schema):
+    dump_fields = getattr(schema, 'dump_fields', None)
+    if dump_fields is not None:
+        return dump_fields.keys()
+    # marshmallow 2
+    return [name for name, field in schema.fields.items()
+            if not field.load_only]
+
+
+def unwrap_field(field):
+    """
+    the field inside containers, e.g. Nested(Foo) for List(Nested(Foo))
+    or Dict(values=Nested(Foo))
+    """
+    if isinstance(field, List):
+        inner = getattr(field, 'inner', None) or field.container
+        return unwrap_field(inner)
+    value_field = (getattr(field, 'value_field', None) or
+                   getattr(field, 'value_container', None))
+    if value_field is not None:
+        return unwrap_field(value_field)
+    return field
+
+
+def path_tree(paths):
+    """
+    ['a', 'b.c', 'b.d'] -> {'a': {}, 'b': {'c': {}, 'd': {}}}
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        for part in path.split('.'):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def tree_paths(tree, prefix=''):
+    """
+    path_tree, backwards: the paths to its leaves
+    """
+    paths = []
+    for name, subtree in sorted(tree.items()):
+        path = prefix + name
+        if subtree:
+            paths.extend(tree_paths(subtree, path + '.'))
+        else:
+            paths.append(path)
+    return paths
+
+
+def freeze_path_tree(tree):
+    """
+    hashable version of a path tree
+    """
+    return frozenset((name, freeze_path_tree(subtree))
+                     for name, subtree in tree.items())
+
+
+def merge_path_trees(tree, other):
+    """
+    merges other into tree, in place
+    """
+    for name, subtree in other.items():
+        merge_path_trees(tree.setdefault(name, {}), subtree)
+    return tree
+
+
+def ensure_instance(schema):
+    """
+    various methods expect instances of schema, but sometimes
+    introspections yield classes (not totally sure why). but we can't
+    just blindly call ProbablyAClass() without sometimes getting
+    not-callable errors.
+    """
+    if isinstance(schema, Schema):
+        return schema
+    # TODO(dmr, 2017-06-07): confirm that is of type
+    # schema-class-thing so errors are more localized
+    elif isinstance(schema, type):
+        return schema()
+    else:
+        raise ValueError('lolwut:', schema)
@@ -0,0 +1,99 @@
+"""
+Per-call numbers about what a SchemaFilter did, for sending to your
+metrics system:
+
+    def observe(stats):
+        statsd.timing('projection.' + stats.schema, stats.introspection_time)
+
+    sf = SchemaFilter(UserSchema(), observer=observe)
+"""
+from collections import namedtuple
+
+from .loaders import as_loader_strategy
+
+# loaders which fetch a link along with its parents; defaultload leaves
+# it to lazy loading
+EAGER_LOADERS = frozenset(['joinedload', 'selectinload', 'subqueryload',
+                           'immediateload', 'contains_eager'])
+
+
+class ProjectionStats(namedtuple('ProjectionStats',
+                                 ['schema', 'model', 'cache_hit',
+                                  'introspection_time', 'options_time',
+                                  'depth', 'options', 'columns',
+                                  'relationships'])):
+    """
+    schema & model are class names. cache_hit is None when there's no
+    cache. introspection_time is how long getting the config took
+    (from the cache, or by walking the schema & mapper) & options_time
+    how long building the loader options & applying them did, both in
+    seconds.
+
+    The rest describe what came out: levels in the config tree (1 for
+    no links), loader options, columns selected & relationships
+    eagerly loaded, all levels together. columns is None without
+    project_columns, since then every column gets selected anyway.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        if self.cache_hit is None:
+            cache = 'uncached'
+        elif self.cache_hit:
+            cache = 'cache hit'
+        else:
+            cache = 'cache miss'
+        if self.columns is None:
+            columns = 'all columns'
+        else:
+            columns = '{} columns'.format(self.columns)
+        return ('{schema} on {model}: {introspection:.3f}ms introspecting '
+                '({cache}), {applying:.3f}ms applying {options} options; '
+                '{columns}, {relationships} relationships, '
+                'depth {depth}').format(
+                    schema=self.schema, model=self.model, cache=cache,
+                    introspection=self.introspection_time * 1000,
+                    applying=self.options_time * 1000, options=self.options,
+                    columns=columns, relationships=self.relationships,
+                    depth=self.depth)
+
+
+def config_shape(cfg, loader='defaultload', project_columns=False,
+                 joined_paths=()):
+    """
+    (depth, columns, relationships) for a config tree, subtypes
+    included, as collect_loader_options would load it with the same
+    arguments: relationships counts the links loaded eagerly, & columns
+    is None unless project_columns.
+    """
+    strategy = as_loader_strategy(loader)
+
+    def shape(cfg, path):
+        depth = 1
+        columns = len(cfg['load_only'] | cfg['required'])
+        relationships = 0
+        for name, child_cfg in cfg['childs'].items():
+            child_path = path + (name,)
+            dotted = '.'.join(child_path)
+            if dotted in joined_paths:
+                child_loader = 'contains_eager'
+            else:
+                child_loader = strategy.loader_name(
+                    dotted, name in cfg['collections'])
+            if child_loader in EAGER_LOADERS:
+                relationships += 1
+            child_depth, child_columns, child_relationships = shape(
+                child_cfg, child_path)
+            depth = max(depth, child_depth + 1)
+            columns += child_columns
+            relationships += child_relationships
+        for subtype_cfg in cfg.get('subtypes', {}).values():
+            sub_depth, sub_columns, sub_relationships = shape(subtype_cfg,
+                                                              path)
+            depth = max(depth, sub_depth)
+            columns += sub_columns
+            relationships += sub_relationships
+        return depth, columns, relationships
+
+    depth, columns, relationships = shape(cfg, ())
+    return depth, columns if project_columns else None, relationships
@@ -4,7 +4,8 @@ from setuptools import setup, find_packages
 # with; no idea what actual requirements are.
 REQUIRES = (
     'marshmallow>=2.10.3',
-    'SQLAlchemy>=1.1.6',
+    # selectinload
+    'SQLAlchemy>=1.2',
 )
 
 setup(
@@ -37,4 +38,9 @@ setup(
         'Topic :: Database',
     ],
     test_suite='tests',
+    # the pytest plugin is opt-in (pytest_plugins in a conftest.py):
+    # get_closest_marker & outcome.force_exception
+    extras_require={
+        'pytest': ['pytest>=3.6', 'pluggy>=1.1'],
+    },
 )
@@ -1,3 +1,4 @@
+import os
 import sys
 import webbrowser
 
@@ -14,6 +15,40 @@ def test(ctx):
     sys.exit(retcode)
 
 
+@task
+def bench(ctx, output=None):
+    # results are JSON; compare two runs with benchmarks/compare.py
+    if output is None:
+        rev = ctx.run('git rev-parse --short HEAD', hide=True).stdout.strip()
+        ctx.run('mkdir -p benchmarks/results')
+        output = 'benchmarks/results/{}.json'.format(rev)
+    with ctx.cd('benchmarks'):
+        ctx.run('python bench_projection.py --output {}'.format(
+            os.path.abspath(output)), echo=True)
+    print('wrote', output)
+
+
+@task
+def bench_import(ctx, output=None):
+    # cold-start cost of importing the package, in fresh interpreters
+    if output is None:
+        rev = ctx.run('git rev-parse --short HEAD', hide=True).stdout.strip()
+        ctx.run('mkdir -p benchmarks/results')
+        output = 'benchmarks/results/{}-import.json'.format(rev)
+    with ctx.cd('benchmarks'):
+        ctx.run('python bench_import.py --output {}'.format(
+            os.path.abspath(output)), echo=True)
+    print('wrote', output)
+
+
+@task
+def export_plans(ctx, filters, output='projection_plans.json'):
+    # filters is module:attribute naming a list of (SchemaFilter, model)
+    # pairs; workers load the file with marshmallow_select.load_plans
+    ctx.run('python -m marshmallow_select.plans {} {}'.format(
+        filters, output), echo=True)
+
+
 @task
 def build(ctx):
     ctx.run('python setup.py sdist', echo=True)
@@ -1,9 +1,40 @@
+import asyncio
+import subprocess
+import sys
+
 import marshmallow
 from marshmallow.fields import (
+    Function,
     List,
+    Method,
     Nested
 )
-from marshmallow_select import SchemaFilter
+from marshmallow_select import (
+    InvalidFieldPath,
+    MultiSchemaFilter,
+    ProjectionCache,
+    ProjectionPlan,
+    SchemaFilter,
+    precompile,
+    schema_for_fields
+)
+from marshmallow_select.loaders import LoaderStrategy
+from marshmallow_select.planner import (
+    SchemaProjectionGenerator,
+    projection_config
+)
+from marshmallow_select.mapper_index import mapper_index
+from marshmallow_select.plans import (
+    dump_config,
+    export_plans,
+    load_config,
+    load_plans
+)
+from marshmallow_select.coverage import (
+    HAS_ORM_EXECUTE,
+    QueryRecorder,
+    check_coverage
+)
 from marshmallow_sqlalchemy import ModelSchema
 import pytest
 import sqlalchemy as sa
@@ -14,15 +45,27 @@ from sqlalchemy import (
     Boolean,
     ForeignKey,
 )
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import (
     declared_attr,
     declarative_base
 )
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import (
     relationship,
-    sessionmaker
+    sessionmaker,
+    synonym
 )
 
+try:
+    import aiosqlite  # noqa: F401
+    from sqlalchemy.ext.asyncio import (
+        AsyncSession,
+        create_async_engine
+    )
+except ImportError:
+    AsyncSession = None
+
 MARSHMALLOW_VERSION_INFO = tuple(
     [int(part) for part in marshmallow.__version__.split('.') if part.isdigit()]
 )
@@ -93,6 +136,88 @@ def models(Base):
     return _models()
 
 
+@pytest.fixture()
+def feed_models(Base, models):
+    class Post(Base):
+        title = Column(String(100))
+        kind = Column(String(20))
+
+        __mapper_args__ = {'polymorphic_on': kind,
+                           'polymorphic_identity': 'post'}
+
+    class Photo(Post):
+        id = Column(Integer, ForeignKey('post.id'), primary_key=True)
+        caption = Column(String(100))
+        image_id = Column(Integer, ForeignKey('image.id'))
+
+        image = relationship('Image')
+
+        __mapper_args__ = {'polymorphic_identity': 'photo'}
+
+    class Link(Post):
+        id = Column(Integer, ForeignKey('post.id'), primary_key=True)
+        href = Column(String(100))
+        preview = Column(String(100))
+
+        __mapper_args__ = {'polymorphic_identity': 'link'}
+
+    class _feed_models(object):
+        def __init__(self):
+            self.Post = Post
+            self.Photo = Photo
+            self.Link = Link
+    return _feed_models()
+
+
+@pytest.fixture()
+def tag_models(Base):
+    class Author(Base):
+        first_name = Column(String(100))
+        last_name = Column(String(100))
+        bio = Column(String(100))
+
+        nickname = synonym('first_name')
+        author_tags = relationship('AuthorTag')
+        tags = association_proxy('author_tags', 'tag')
+        tag_names = association_proxy('author_tags', 'tag_name')
+
+        @hybrid_property
+        def full_name(self):
+            return self.first_name + ' ' + self.last_name
+
+    class AuthorTag(Base):
+        author_id = Column(Integer, ForeignKey('author.id'))
+        tag_id = Column(Integer, ForeignKey('tag.id'))
+
+        tag = relationship('Tag')
+        tag_name = association_proxy('tag', 'name')
+
+    class Tag(Base):
+        name = Column(String(100))
+        description = Column(String(100))
+
+    class _tag_models(object):
+        def __init__(self):
+            self.Author = Author
+            self.AuthorTag = AuthorTag
+            self.Tag = Tag
+    return _tag_models()
+
+
+@pytest.fixture()
+def tree_models(Base):
+    class Category(Base):
+        name = Column(String(100))
+        parent_id = Column(Integer, ForeignKey('category.id'))
+
+        children = relationship('Category', order_by='Category.id')
+
+    class _tree_models(object):
+        def __init__(self):
+            self.Category = Category
+    return _tree_models()
+
+
 @pytest.fixture()
 def shallow_schemas(models):
     class ShallowUserSchema(ModelSchema):
@@ -403,6 +528,1040 @@ class TestJoining:
         assert (qc3 - qc2) == 1, 'did not get other img'
 
 
+class TestProjectColumns:
+    def test_list(self, session, list_schema, list_out, models, instances):
+        session.commit()
+        qc_before = query_counter
+
+        qry = session.query(models.User)
+        sf = SchemaFilter(list_schema(), unlazify=True, project_columns=True)
+        qry = sf(qry)
+        sql = str(qry)
+        obj = qry.all()
+        qc_fetch = query_counter
+        data = unpack(list_schema(many=True).dump(obj))
+        qc_dump = query_counter
+
+        assert data == list_out, 'projected: data correct'
+        assert qc_fetch - qc_before == 1, 'projected: 1 to fetch'
+        assert qc_dump - qc_fetch == 0, 'projected: 0 to dump'
+
+        assert 'AS user_first_name' in sql
+        assert 'AS user_email' not in sql
+        assert 'AS user_last_name' not in sql
+        assert 'AS image_1_url' in sql
+        assert 'AS image_1_is_default' not in sql
+
+    def test_keeps_join_keys(self, session, all_detail_schemas, models,
+                             instances):
+        # links we load keep their foreign keys, in case they get loaded
+        # separately from the parent row
+        session.commit()
+
+        qry = session.query(models.Like)
+        sf = SchemaFilter(all_detail_schemas.LikeForUserDetailSchema(),
+                          unlazify=True, project_columns=True)
+        sql = str(sf(qry))
+        assert 'AS like_image_id' in sql
+        assert 'AS like_user_id' not in sql
+
+        likes = sf(qry).all()
+        assert [like.image.url for like in likes] == ['goatse.cx/giver.jpg',
+                                                     'goatse.cx/receiver.jpg']
+
+
+class TestStrategy:
+    def fetch_and_dump(self, session, models, schema, qry):
+        session.commit()
+        qc_before = query_counter
+        objs = qry.all()
+        qc_fetch = query_counter
+        data = unpack(schema(many=True).dump(objs))
+        qc_dump = query_counter
+        return data, qc_fetch - qc_before, qc_dump - qc_fetch
+
+    def test_auto(self, session, detail_schema, detail_out, models, instances):
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+        sf = SchemaFilter(detail_schema(), strategy='auto')
+        qry = sf(qry)
+        # no collection gets joined into the main query
+        assert 'JOIN' not in str(qry)
+
+        data, fetches, dumps = self.fetch_and_dump(session, models,
+                                                   detail_schema, qry)
+        assert data == [detail_out]
+        assert fetches == 3, 'users, then images & likes (w/ joined image)'
+        assert dumps == 0
+
+    def test_overrides(self, session, detail_schema, detail_out, models,
+                       instances):
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+        sf = SchemaFilter(detail_schema(), strategy='auto',
+                          path_loaders={'likes.image': 'selectinload',
+                                        'images': sa.orm.joinedload})
+        qry = sf(qry)
+
+        data, fetches, dumps = self.fetch_and_dump(session, models,
+                                                   detail_schema, qry)
+        assert data == [detail_out]
+        assert fetches == 3, 'users w/ images, then likes, then their images'
+        assert dumps == 0
+
+    def test_bad_loader(self, detail_schema):
+        with pytest.raises(ValueError):
+            SchemaFilter(detail_schema(), strategy='lolwut')
+
+
+class TestReuseJoins:
+    def test_contains_eager(self, session, detail_schema, detail_out, models,
+                            instances):
+        session.commit()
+        User = models.User
+        qc_before = query_counter
+
+        qry = (session.query(User)
+               .outerjoin(User.images)
+               .outerjoin(User.likes)
+               .filter(User.id==instances['user_id']))
+        sf = SchemaFilter(detail_schema(), unlazify=True, reuse_joins=True,
+                          project_columns=True)
+        qry = sf(qry)
+        sql = str(qry)
+        # not .first(): its LIMIT would cut the joined collections short
+        objs = qry.all()
+        qc_fetch = query_counter
+        assert len(objs) == 1
+        data = unpack(detail_schema().dump(objs[0]))
+        qc_dump = query_counter
+
+        assert data == detail_out
+        assert qc_fetch - qc_before == 1, 'reused: 1 to fetch'
+        assert qc_dump - qc_fetch == 0, 'reused: 0 to dump'
+
+        # images & likes come from the existing joins, likes.image gets
+        # joinedloaded, and all of them are still projected
+        assert sql.count('JOIN') == 3
+        assert 'image_2' not in sql
+        assert 'AS image_url' in sql
+        assert 'AS image_is_default' not in sql
+        assert 'AS like_user_id' not in sql
+
+    def test_joined_paths(self, session, models):
+        from marshmallow_select.schema_filter import query_joined_paths
+        User, Image, Like = models.User, models.Image, models.Like
+
+        qry = session.query(User).join(User.likes).join(Like.image)
+        assert query_joined_paths(qry, User) == {'likes', 'likes.image'}
+
+        qry = session.query(User).join(Image, User.images)
+        assert query_joined_paths(qry, User) == {'images'}
+
+        if hasattr(sa.sql.Select, 'join_from'):
+            stmt = sa.select(User).join(User.likes).join(Like.image)
+            assert query_joined_paths(stmt, User) == {'likes', 'likes.image'}
+
+        # aliased, or not from the root: can't reuse
+        qry = session.query(User).join(User.images.of_type(sa.orm.aliased(Image)))
+        assert query_joined_paths(qry, User) == set()
+        qry = session.query(User).join(Like.image)
+        assert query_joined_paths(qry, User) == set()
+
+
+class TestMultiEntity:
+    def test_join(self, session, all_list_schemas, list_out, models,
+                  instances):
+        session.commit()
+        UserSchema = all_list_schemas.UserListEltSchema
+        ImageSchema = all_list_schemas.ImageForUserListEltSchema
+        qc_before = query_counter
+
+        qry = (session.query(models.User, models.Image)
+               .join(models.Image, models.Image.user_id == models.User.id)
+               .filter(models.Image.is_default == True)  # noqa: E712
+               .order_by(models.User.id))
+        sf = MultiSchemaFilter({models.User: UserSchema(),
+                                models.Image: ImageSchema()},
+                               unlazify=True, project_columns=True)
+        qry = sf(qry)
+        sql = str(qry)
+        rows = qry.all()
+        qc_fetch = query_counter
+        users = unpack(UserSchema(many=True).dump([u for u, i in rows]))
+        images = unpack(ImageSchema(many=True).dump([i for u, i in rows]))
+        qc_dump = query_counter
+
+        assert users == list_out
+        assert images == [user['default_image'] for user in list_out]
+        assert qc_fetch - qc_before == 1, 'multi: 1 to fetch'
+        assert qc_dump - qc_fetch == 0, 'multi: 0 to dump'
+
+        assert 'AS user_email' not in sql
+        assert 'AS image_url' in sql
+        assert 'AS image_user_id' not in sql
+
+    def test_first_entity_only(self, session, list_schema, models):
+        # plain SchemaFilter on a multi-entity query leaves the others be
+        qry = (session.query(models.User, models.Image)
+               .join(models.Image, models.Image.user_id == models.User.id))
+        sql = str(SchemaFilter(list_schema(), project_columns=True)(qry))
+        assert 'AS user_email' not in sql
+        assert 'AS image_user_id' in sql
+
+
+class TestCoverage:
+    def test_covered(self, session, detail_schema, detail_out, models,
+                     instances):
+        session.commit()
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+        report = check_coverage(detail_schema, qry)
+
+        assert report.covered
+        assert report.data == [detail_out]
+        assert len(report.fetch_queries) == 1
+        assert report.extra_queries == []
+
+    def test_not_covered(self, session, detail_schema, detail_out, models,
+                         instances):
+        session.commit()
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+        report = check_coverage(detail_schema, qry,
+                                schema_filter=lambda qry: qry)
+
+        assert not report.covered
+        assert report.data == [detail_out]
+        assert len(report.extra_queries) == 3
+        if HAS_ORM_EXECUTE:
+            assert sorted(report.paths) == ['Like.image', 'User.images',
+                                            'User.likes']
+            assert 'loading Like.image' in str(report)
+
+
+class TestPolymorphic:
+    def test_subtype_schemas(self, feed_models, models, session):
+        class ImageUrlSchema(ModelSchema):
+            class Meta:
+                model = models.Image
+                fields = ('id', 'url')
+
+        class PostSchema(ModelSchema):
+            class Meta:
+                model = feed_models.Post
+                fields = ('id', 'title')
+
+        class PhotoSchema(ModelSchema):
+            image = Nested(ImageUrlSchema)
+
+            class Meta:
+                model = feed_models.Photo
+                fields = ('id', 'title', 'caption', 'image')
+
+        class LinkSchema(ModelSchema):
+            class Meta:
+                model = feed_models.Link
+                fields = ('id', 'title', 'href')
+
+        image = models.Image(url='zombo.com/logo.png')
+        session.add_all([
+            feed_models.Photo(title='a', caption='b', image=image),
+            feed_models.Link(title='c', href='zombo.com', preview='d'),
+            feed_models.Photo(title='e', caption='f', image=image),
+            feed_models.Post(title='g'),
+        ])
+        session.commit()
+
+        by_kind = {'post': PostSchema(), 'photo': PhotoSchema(),
+                   'link': LinkSchema()}
+        sf = SchemaFilter(PostSchema, unlazify=True, project_columns=True,
+                          subtype_schemas={feed_models.Photo: PhotoSchema,
+                                           'link': LinkSchema})
+        qry = session.query(feed_models.Post).order_by(feed_models.Post.id)
+        with QueryRecorder(session) as recorder:
+            posts = sf(qry).all()
+            fetched = recorder.mark()
+            data = [unpack(by_kind[post.kind].dump(post)) for post in posts]
+
+        assert data == [
+            {'id': 1, 'title': 'a', 'caption': 'b',
+             'image': {'id': 1, 'url': 'zombo.com/logo.png'}},
+            {'id': 2, 'title': 'c', 'href': 'zombo.com'},
+            {'id': 3, 'title': 'e', 'caption': 'f',
+             'image': {'id': 1, 'url': 'zombo.com/logo.png'}},
+            {'id': 4, 'title': 'g'},
+        ]
+        # posts, then one query per subtype however many rows there are
+        assert fetched == 3, 'polymorphic: 3 to fetch'
+        assert len(recorder.queries) == fetched, 'polymorphic: 0 to dump'
+
+        sql = '\n'.join(query.statement for query in recorder.queries)
+        assert 'AS link_href' in sql
+        assert 'AS link_preview' not in sql
+        assert 'AS image_1_is_default' not in sql
+
+    def test_not_a_subtype(self, models, feed_models, list_schema):
+        sf = SchemaFilter(list_schema, subtype_schemas={feed_models.Photo:
+                                                        list_schema})
+        with pytest.raises(ValueError):
+            sf.compile(models.User)
+
+
+class CategorySchema(marshmallow.Schema):
+    # at module level: marshmallow's class registry only keeps the first
+    # class of a given name per module, so Nested('CategorySchema') in
+    # one defined per test would point at another test's
+    id = marshmallow.fields.Integer()
+    name = marshmallow.fields.String()
+    children = List(Nested('CategorySchema'))
+
+
+class TestCycles:
+    @pytest.fixture(name='CategorySchema')
+    def category_schema(self):
+        return CategorySchema
+
+    @pytest.fixture()
+    def tree(self, tree_models, session):
+        Category = tree_models.Category
+        session.add(Category(name='a', children=[
+            Category(name='b', children=[Category(name='c')]),
+            Category(name='d'),
+        ]))
+        session.commit()
+
+    def test_cut(self, CategorySchema, tree_models):
+        # without max_depth, the first repeat of the schema is left to
+        # lazy loading
+        cfg = SchemaProjectionGenerator(CategorySchema(),
+                                        tree_models.Category).config
+        assert cfg['childs'] == {}
+        assert cfg['lazy'] == {'children'}
+
+    @pytest.mark.parametrize('unlazify', [False, True])
+    def test_cut_dump(self, CategorySchema, tree_models, session, tree,
+                      unlazify):
+        Category = tree_models.Category
+        qry = session.query(Category).filter(Category.parent_id == None)  # noqa: E711
+        expected = unpack(CategorySchema().dump(qry.one()))
+        session.expunge_all()
+
+        sf = SchemaFilter(CategorySchema, unlazify=unlazify)
+        data = unpack(CategorySchema().dump(sf(qry).one()))
+        assert data == expected
+        assert [child['name'] for child in data['children']] == ['b', 'd']
+
+    def test_cut_raiseload(self, CategorySchema, tree_models, session, tree):
+        Category = tree_models.Category
+        sf = SchemaFilter(CategorySchema, unlazify=True, raiseload=True)
+        obj = sf(session.query(Category).filter(Category.parent_id == None)).one()  # noqa: E711
+        with pytest.raises(sa.exc.InvalidRequestError):
+            obj.children
+
+    def test_lattice(self, Base):
+        # each level has two schemas nesting both of the next level's:
+        # 2 ** levels paths, but only 2 * levels distinct nodes
+        class Node(Base):
+            left_id = Column(Integer, ForeignKey('node.id'))
+            right_id = Column(Integer, ForeignKey('node.id'))
+            left = relationship('Node', foreign_keys=[left_id],
+                                remote_side='Node.id')
+            right = relationship('Node', foreign_keys=[right_id],
+                                 remote_side='Node.id')
+
+        levels = 16
+        level = []
+        for depth in range(levels):
+            attrs = {'id': marshmallow.fields.Integer()}
+            if level:
+                attrs['left'] = Nested(level[0])
+                attrs['right'] = Nested(level[1])
+            level = [type(name + str(depth), (marshmallow.Schema,), dict(attrs))
+                     for name in ('A', 'B')]
+
+        built = []
+
+        class CountingGenerator(SchemaProjectionGenerator):
+            def __init__(self, *args, **kwargs):
+                super(CountingGenerator, self).__init__(*args, **kwargs)
+                built.append(self)
+
+        cfg = CountingGenerator(level[0](), Node).config
+        assert len(built) < 4 * 2 * levels
+        left, right = cfg['childs']['left'], cfg['childs']['right']
+        assert left['childs']['left'] is right['childs']['left']
+
+    def test_max_depth(self, CategorySchema, tree_models, session, tree):
+        Category = tree_models.Category
+        qc_before = query_counter
+
+        sf = SchemaFilter(CategorySchema, unlazify=True, max_depth=3)
+        qry = sf(session.query(Category).filter(Category.parent_id == None))  # noqa: E711
+        obj = qry.one()
+        qc_fetch = query_counter
+        data = unpack(CategorySchema().dump(obj))
+        qc_dump = query_counter
+
+        assert data == {'id': 1, 'name': 'a', 'children': [
+            {'id': 2, 'name': 'b', 'children': [
+                {'id': 4, 'name': 'c', 'children': []}]},
+            {'id': 3, 'name': 'd', 'children': []},
+        ]}
+        assert qc_fetch - qc_before == 1, 'tree: 1 to fetch'
+        assert qc_dump - qc_fetch == 0, 'tree: 0 to dump'
+
+    def test_past_max_depth(self, CategorySchema, tree_models, session, tree):
+        Category = tree_models.Category
+        sf = SchemaFilter(CategorySchema, unlazify=True, max_depth=1,
+                          raiseload=True)
+        qry = sf(session.query(Category).filter(Category.parent_id == None))  # noqa: E711
+        obj = qry.one()
+
+        assert [child.name for child in obj.children] == ['b', 'd']
+        with pytest.raises(sa.exc.InvalidRequestError):
+            obj.children[0].children
+
+    def test_shared_subtrees(self, schemas, models):
+        class TwoImagesSchema(schemas.UserSchema):
+            images = List(Nested(schemas.ImageSchema, only=['id', 'url']))
+            default_image = Nested(schemas.ImageSchema, only=['id', 'url'])
+
+            class Meta:
+                fields = ['id', 'images', 'default_image']
+
+        cfg = SchemaProjectionGenerator(TwoImagesSchema(), models.User).config
+        assert cfg['childs']['images'] is cfg['childs']['default_image']
+
+
+class TestDependencies:
+    def test_columns(self, session, schemas, models, instances):
+        class NameSchema(schemas.UserSchema):
+            full_name = Function(lambda user: ' '.join([user.first_name,
+                                                        user.last_name]))
+
+            class Meta:
+                fields = ['id', 'full_name']
+                select_dependencies = {
+                    'full_name': ['first_name', 'last_name'],
+                }
+
+        session.commit()
+        qry = session.query(models.User).order_by(models.User.id)
+        sf = SchemaFilter(NameSchema(), project_columns=True)
+        sql = str(sf(qry))
+        assert 'AS user_first_name' in sql
+        assert 'AS user_email' not in sql
+
+        report = check_coverage(NameSchema, qry, project_columns=True)
+        assert report.covered
+        assert report.data == [{'id': 1, 'full_name': 'a b'},
+                               {'id': 2, 'full_name': 'd e'}]
+
+    def test_links(self, session, schemas, models, instances):
+        class LikeSchema(schemas.LikeSchema):
+            image_url = Function(lambda like: like.image.url)
+            owner = Function(lambda like: like.user.first_name)
+
+            class Meta:
+                fields = ['id', 'image_url', 'owner']
+                select_dependencies = {
+                    'image_url': ['image.url'],
+                    'owner': ['user'],
+                }
+
+        session.commit()
+        qry = session.query(models.Like).order_by(models.Like.id)
+        sql = str(SchemaFilter(LikeSchema(), unlazify=True,
+                               project_columns=True)(qry))
+        assert 'AS image_1_url' in sql
+        assert 'AS image_1_is_default' not in sql
+        assert 'AS user_1_email' in sql, 'bare link gets all columns'
+
+        report = check_coverage(LikeSchema, qry, project_columns=True)
+        assert report.covered
+        assert report.data == [
+            {'id': 1, 'image_url': 'goatse.cx/giver.jpg', 'owner': 'a'},
+            {'id': 2, 'image_url': 'goatse.cx/receiver.jpg', 'owner': 'd'},
+        ]
+
+
+class TestFieldTypes:
+    def test_attributes(self, session, schemas, all_list_schemas, models,
+                        instances):
+        ImageSchema = all_list_schemas.ImageForUserListEltSchema
+
+        class LikeSchema(schemas.LikeSchema):
+            image_url = marshmallow.fields.String(attribute='image.url')
+            picture = Nested(ImageSchema, attribute='image')
+            owner_image = Nested(ImageSchema, attribute='user.default_image')
+            label = Method('get_label', metadata={
+                'select_dependencies': ['user.first_name']})
+
+            def get_label(self, like):
+                return 'liked by ' + like.user.first_name
+
+            class Meta:
+                fields = ['id', 'image_url', 'picture', 'owner_image',
+                          'label']
+
+        session.commit()
+        qry = session.query(models.Like).order_by(models.Like.id)
+        sql = str(SchemaFilter(LikeSchema(), unlazify=True,
+                               project_columns=True)(qry))
+        assert 'AS user_1_first_name' in sql
+        assert 'AS user_1_email' not in sql
+        assert 'AS image_2_is_default' not in sql
+
+        report = check_coverage(LikeSchema, qry, project_columns=True)
+        assert report.covered, str(report)
+        assert report.data == [
+            {'id': 1,
+             'image_url': 'goatse.cx/giver.jpg',
+             'picture': {'id': 2, 'url': 'goatse.cx/giver.jpg'},
+             'owner_image': {'id': 1, 'url': 'goatse.cx/receiver.jpg'},
+             'label': 'liked by a'},
+            {'id': 2,
+             'image_url': 'goatse.cx/receiver.jpg',
+             'picture': {'id': 1, 'url': 'goatse.cx/receiver.jpg'},
+             'owner_image': {'id': 2, 'url': 'goatse.cx/giver.jpg'},
+             'label': 'liked by d'},
+        ]
+
+    @pytest.mark.skipif(MARSHMALLOW_VERSION_INFO[0] < 3,
+                        reason='Pluck & Dict(values=) need marshmallow 3')
+    def test_pluck_and_dict(self, schemas, shallow_schemas, models):
+        from marshmallow.fields import Dict, Pluck
+
+        class UserSchema(schemas.UserSchema):
+            image_urls = List(Pluck(schemas.ImageSchema, 'url'),
+                              attribute='images')
+            likes_by_id = Dict(keys=marshmallow.fields.String(),
+                               values=Nested(shallow_schemas.ShallowLikeSchema),
+                               attribute='likes')
+
+            class Meta:
+                fields = ['id', 'image_urls', 'likes_by_id']
+
+        cfg = SchemaProjectionGenerator(UserSchema(), models.User).config
+        assert cfg['childs']['images']['load_only'] == {'url'}
+        assert cfg['childs']['likes']['load_only'] == {'id'}
+
+
+class TestDescriptors:
+    def test_proxies(self, tag_models, session):
+        class TagSchema(marshmallow.Schema):
+            id = marshmallow.fields.Integer()
+            name = marshmallow.fields.String()
+
+        class AuthorSchema(marshmallow.Schema):
+            id = marshmallow.fields.Integer()
+            nickname = marshmallow.fields.String()
+            full_name = marshmallow.fields.String()
+            tag_names = List(marshmallow.fields.String())
+            tags = List(Nested(TagSchema))
+
+        Author, AuthorTag, Tag = (tag_models.Author, tag_models.AuthorTag,
+                                  tag_models.Tag)
+        tags = [Tag(name='x', description='y'), Tag(name='z')]
+        session.add(Author(first_name='a', last_name='b', bio='c',
+                           author_tags=[AuthorTag(tag=tag) for tag in tags]))
+        session.commit()
+        qc_before = query_counter
+
+        sf = SchemaFilter(AuthorSchema, unlazify=True, project_columns=True)
+        qry = sf(session.query(Author))
+        sql = str(qry)
+        obj = qry.one()
+        qc_fetch = query_counter
+        data = unpack(AuthorSchema().dump(obj))
+        qc_dump = query_counter
+
+        assert data == {'id': 1, 'nickname': 'a', 'full_name': 'a b',
+                        'tag_names': ['x', 'z'],
+                        'tags': [{'id': 1, 'name': 'x'},
+                                 {'id': 2, 'name': 'z'}]}
+        assert qc_fetch - qc_before == 1, 'descriptors: 1 to fetch'
+        assert qc_dump - qc_fetch == 0, 'descriptors: 0 to dump'
+        assert 'AS author_bio' not in sql
+        assert 'description' not in sql
+
+
+class TestFieldSets:
+    @pytest.mark.skipif(MARSHMALLOW_VERSION_INFO[0] < 3,
+                        reason='dotted only needs marshmallow 3')
+    def test_dotted_only(self, session, detail_schema, models, instances):
+        session.commit()
+        schema = detail_schema(only=('id', 'likes.image.url'))
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+        sql = str(SchemaFilter(schema, unlazify=True, project_columns=True)(qry))
+        assert 'AS user_first_name' not in sql
+        assert sql.count('JOIN') == 2, 'only likes & their images'
+        assert 'AS image_1_url' in sql
+        assert 'AS image_1_is_default' not in sql
+
+        report = check_coverage(schema, qry, project_columns=True)
+        assert report.covered
+        assert report.data == [{'id': 1,
+                                'likes': [{'image': {'url': 'goatse.cx/giver.jpg'}}]}]
+
+    @pytest.mark.skipif(MARSHMALLOW_VERSION_INFO[0] < 3,
+                        reason='dotted only needs marshmallow 3')
+    def test_dotted_only_cached(self, session, detail_schema, models,
+                                instances):
+        # marshmallow 3 moves 'likes.id' off schema.only & onto the
+        # likes field, so the cache key has to look there too
+        session.commit()
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+
+        schema = detail_schema(only=('id', 'likes.id'))
+        objs = SchemaFilter(schema, unlazify=True, project_columns=True)(qry).all()
+        assert unpack(schema.dump(objs[0])) == {'id': 1, 'likes': [{'id': 1}]}
+        session.expunge_all()
+
+        schema = detail_schema(only=('id', 'likes.image'))
+        objs = SchemaFilter(schema, unlazify=True, project_columns=True)(qry).all()
+        assert unpack(schema.dump(objs[0])) == {
+            'id': 1,
+            'likes': [{'image': {'id': 2, 'url': 'goatse.cx/giver.jpg'}}],
+        }
+
+    def test_dump_aware(self, session, list_schema, models):
+        qry = session.query(models.User)
+        schema = list_schema(load_only=('first_name',))
+
+        sql = str(SchemaFilter(schema, project_columns=True)(qry))
+        assert 'AS user_first_name' in sql, 'fetched by default'
+
+        sql = str(SchemaFilter(schema, project_columns=True,
+                               dump_aware=True)(qry))
+        assert 'AS user_first_name' not in sql
+
+
+class TestSparseFields:
+    def test_for_fields(self, session, detail_schema, models, instances):
+        session.commit()
+        paths = ['id', 'first_name', 'likes.image.url', 'images']
+        sf = SchemaFilter.for_fields(detail_schema, paths, unlazify=True,
+                                     project_columns=True)
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+        sql = str(sf(qry))
+        assert 'AS user_first_name' in sql
+        assert 'AS user_email' not in sql
+        assert 'AS like_1_image_id' in sql
+        assert 'AS image_1_id' in sql, 'all of images'
+        assert 'AS image_1_url' in sql, 'all of images'
+
+        schema = schema_for_fields(detail_schema, paths)
+        if MARSHMALLOW_VERSION_INFO[0] >= 3:
+            report = check_coverage(schema, qry, schema_filter=sf)
+            assert report.covered
+            assert report.data == [{
+                'id': 1,
+                'first_name': 'a',
+                'images': [{'id': 1, 'url': 'goatse.cx/receiver.jpg'}],
+                'likes': [{'image': {'url': 'goatse.cx/giver.jpg'}}],
+            }]
+
+    def test_invalid(self, detail_schema):
+        with pytest.raises(InvalidFieldPath):
+            SchemaFilter.for_fields(detail_schema, ['id', 'likes.nope'])
+        with pytest.raises(InvalidFieldPath):
+            SchemaFilter.for_fields(detail_schema, ['first_name.nope'])
+        with pytest.raises(ValueError):
+            schema_for_fields(detail_schema, ['nope'])
+
+
+class TestRaiseload:
+    def test_missed_link(self, session, list_schema, models, instances):
+        session.commit()
+        sf = SchemaFilter(list_schema(), unlazify=True, raiseload=True)
+        users = sf(session.query(models.User)).all()
+
+        assert users[0].default_image.url == 'goatse.cx/receiver.jpg'
+        with pytest.raises(sa.exc.InvalidRequestError):
+            users[0].images
+
+    @pytest.mark.skipif(not HAS_ORM_EXECUTE, reason='needs SQLAlchemy 1.4+')
+    def test_strict(self, session, detail_schema, detail_out, list_schema,
+                    models, instances):
+        session.commit()
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+        report = check_coverage(detail_schema, qry, strict=True)
+        assert report.covered
+        assert report.data == [detail_out]
+
+        sf = SchemaFilter(list_schema(), unlazify=True, strict=True)
+        user = sf(qry).one()
+        assert user.first_name == 'a'
+        with pytest.raises(sa.exc.InvalidRequestError, match='email'):
+            user.email
+        with pytest.raises(sa.exc.InvalidRequestError, match='images'):
+            user.images
+
+
+@pytest.mark.skipif(AsyncSession is None,
+                    reason='needs SQLAlchemy 1.4+ & aiosqlite')
+class TestAsync:
+    def test_select(self, Base, models, detail_schema, detail_out, tmp_path):
+        url = 'sqlite+aiosqlite:///{}'.format(tmp_path / 'test.db')
+        sf = SchemaFilter(detail_schema(), strategy='auto', raiseload=True)
+
+        async def run():
+            engine = create_async_engine(url)
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            async with AsyncSession(engine) as session:
+                u = models.User(first_name='a', last_name='b', email='c')
+                v = models.User(first_name='d', last_name='e', email='f')
+                i0 = models.Image(user=u, url="goatse.cx/receiver.jpg",
+                                  is_default=True)
+                i1 = models.Image(user=v, url="goatse.cx/giver.jpg",
+                                  is_default=True)
+                session.add_all([u, v, i0, i1, models.Like(user=u, image=i1)])
+                await session.commit()
+
+            async with AsyncSession(engine) as session:
+                stmt = sf(sa.select(models.User).where(models.User.id == 1))
+                users = (await session.execute(stmt)).scalars().all()
+                # a lazy load here would raise, being outside the greenlet
+                data = unpack(detail_schema(many=True).dump(users))
+            await engine.dispose()
+            return data
+
+        assert asyncio.run(run()) == [detail_out]
+
+
+class TestStream:
+    def test_chunks(self, session, detail_schema, detail_out, models,
+                    instances):
+        session.commit()
+        qc_before = query_counter
+
+        sf = SchemaFilter(detail_schema())
+        qry = session.query(models.User).order_by(models.User.id)
+        data = list(sf.stream(qry, chunk_size=1))
+
+        assert data[0] == detail_out, 'stream: data correct'
+        assert len(data) == 2
+        # users, then images & likes (with their image joined) per chunk
+        assert query_counter - qc_before == 1 + 2 * 2, 'stream: 2 per chunk'
+        assert list(session) == [], 'stream: chunks expunged'
+
+    def test_for_fields(self, session, detail_schema, models, instances):
+        session.commit()
+        sf = SchemaFilter.for_fields(detail_schema, ['id', 'first_name',
+                                                     'images.url'],
+                                     strict=True)
+        qry = session.query(models.User).order_by(models.User.id)
+        data = list(sf.stream(qry))
+        assert data[0] == {'id': 1, 'first_name': 'a',
+                           'images': [{'url': 'goatse.cx/receiver.jpg'}]}
+
+    def test_strategy(self):
+        strategy = LoaderStrategy('defaultload',
+                                  overrides={'likes': 'joinedload'})
+        streaming = strategy.streaming()
+        assert streaming.loader_name('likes', True) == 'selectinload'
+        assert streaming.loader_name('images', True) == 'selectinload'
+        assert streaming.loader_name('default_image', False) == 'joinedload'
+
+
+class TestCoreSelect:
+    def test_detail(self, session, detail_schema, detail_out, models,
+                    instances):
+        session.commit()
+        qc_before = query_counter
+
+        plan = SchemaFilter(detail_schema()).to_select(models.User)
+        stmt = plan.statement.where(models.User.id == instances['user_id'])
+        data = plan.execute(session, stmt)
+
+        assert data == [detail_out], 'core: data correct'
+        # users, then images & likes (with their image joined)
+        assert query_counter - qc_before == 3, 'core: 1 per collection'
+
+    def test_list(self, session, list_schema, list_out, models, instances):
+        session.commit()
+        plan = SchemaFilter(list_schema()).to_select(models.User)
+        sql = str(plan.statement)
+        data = plan.execute(session, plan.statement.order_by(models.User.id))
+
+        assert data == list_out
+        assert 'LEFT OUTER JOIN image' in sql
+        assert 'email' not in sql
+
+    def test_sparse(self, session, detail_schema, models, instances):
+        session.commit()
+        sf = SchemaFilter.for_fields(detail_schema, ['id', 'likes.image.url'])
+        stmt = sf.to_select(models.User).statement.order_by(models.User.id)
+        data = sf.to_select(models.User).execute(session, stmt)
+
+        assert data == [
+            {'id': 1, 'likes': [{'image': {'url': 'goatse.cx/giver.jpg'}}]},
+            {'id': 2, 'likes': [{'image': {'url': 'goatse.cx/receiver.jpg'}}]},
+        ]
+
+    def test_cycle(self, session, schemas, models, instances):
+        # user.images.user repeats the root, so it's cut there, as it
+        # would be for the ORM; without lazy loading, it's left out
+        class ImageSchema(schemas.ImageSchema):
+            user = Nested(lambda: UserSchema)
+
+            class Meta:
+                fields = ['id', 'url', 'user']
+
+        class UserSchema(schemas.UserSchema):
+            images = List(Nested(ImageSchema))
+
+            class Meta:
+                fields = ['id', 'first_name', 'images']
+
+        session.commit()
+        plan = SchemaFilter(UserSchema).to_select(models.User)
+        stmt = plan.statement.where(models.User.id == instances['user_id'])
+        assert plan.execute(session, stmt) == [{
+            'id': 1,
+            'first_name': 'a',
+            'images': [{'id': 1, 'url': 'goatse.cx/receiver.jpg'}],
+        }]
+
+        # the full fixture schemas stop at a field that isn't a column
+        # rather than recursing forever
+        with pytest.raises(ValueError):
+            SchemaFilter(schemas.UserSchema).to_select(models.User)
+
+    def test_max_depth(self, tree_models, session):
+        Category = tree_models.Category
+        session.add(Category(name='a', children=[
+            Category(name='b', children=[Category(name='c')]),
+            Category(name='d'),
+        ]))
+        session.commit()
+
+        plan = SchemaFilter(CategorySchema, max_depth=2).to_select(Category)
+        stmt = plan.statement.where(Category.parent_id == None)  # noqa: E711
+        assert plan.execute(session, stmt) == [{
+            'id': 1,
+            'name': 'a',
+            'children': [
+                {'id': 2, 'name': 'b', 'children': [{'id': 4, 'name': 'c'}]},
+                {'id': 3, 'name': 'd', 'children': []},
+            ],
+        }]
+
+    def test_not_a_column(self, list_schema, models):
+        class NameSchema(list_schema):
+            full_name = Function(lambda user: user.first_name)
+
+            class Meta:
+                fields = ['id', 'full_name']
+
+        with pytest.raises(ValueError):
+            SchemaFilter(NameSchema).to_select(models.User)
+
+
+class TestCache:
+    def test_hit(self, session, detail_schema, models, instances):
+        cache = ProjectionCache()
+        sf = SchemaFilter(detail_schema(), unlazify=True, cache=cache)
+
+        qry = session.query(models.User)
+        str(sf(qry))
+        str(sf(qry))
+        assert cache.info() == {'hits': 1, 'misses': 1,
+                                'maxsize': 256, 'currsize': 1}
+
+        # different instance options are a different shape
+        sf = SchemaFilter(detail_schema(exclude=['email']), cache=cache)
+        sf(qry)
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        cache.clear()
+        assert cache.info()['currsize'] == 0
+        assert (cache.hits, cache.misses) == (0, 0)
+
+    def test_lru(self):
+        cache = ProjectionCache(maxsize=2)
+        cache.get_or_build('a', lambda: 1)
+        cache.get_or_build('b', lambda: 2)
+        cache.get_or_build('a', lambda: 1)
+        cache.get_or_build('c', lambda: 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+
+        cache.resize(1)
+        assert len(cache) == 1
+        assert 'c' in cache
+
+
+class TestMapperIndex:
+    def test_index(self, models):
+        index = mapper_index(models.User)
+        assert mapper_index(sa.inspect(models.User)) is index
+        assert index.columns == {'id', 'first_name', 'last_name', 'email'}
+        assert index.relationships == {'images', 'default_image', 'likes'}
+        assert index.key_names == {'id'}
+        assert index.links['images'].target is models.Image
+        assert index.links['images'].uselist
+        assert not index.links['default_image'].uselist
+
+        image_index = mapper_index(models.Image)
+        assert image_index.foreign_key_names == {'user_id'}
+        assert image_index.links['user'].local_names == {'user_id'}
+
+    def test_invalidated_on_configure(self, Base, models):
+        index = mapper_index(models.User)
+
+        class Comment(Base):
+            user_id = Column(Integer, ForeignKey('user.id'))
+            user = relationship('User', backref='comments')
+
+        sa.orm.configure_mappers()
+        new_index = mapper_index(models.User)
+        assert new_index is not index
+        assert 'comments' in new_index.relationships
+
+
+class TestObserver:
+    def test_stats(self, session, detail_schema, models):
+        reports = []
+        sf = SchemaFilter(detail_schema(), unlazify=True,
+                          project_columns=True, cache=ProjectionCache(),
+                          observer=reports.append)
+        qry = session.query(models.User)
+        sf(qry)
+        sf(qry)
+
+        first, second = reports
+        assert (first.cache_hit, second.cache_hit) == (False, True)
+        assert first.schema == 'UserDetailSchema'
+        assert first.model == 'User'
+        # user -> likes -> image
+        assert first.depth == 3
+        assert first.relationships == 3
+        # id/first_name/last_name/email, id/url, id/image_id, id/url
+        assert first.columns == 10
+        assert first.options == len(sf.loader_options(models.User))
+        assert first.introspection_time >= 0
+        assert 'UserDetailSchema on User' in str(first)
+        assert 'cache miss' in str(first)
+
+    def test_lazy_stats(self, session, detail_schema, models):
+        # links are only defaultloaded & every column is selected
+        reports = []
+        sf = SchemaFilter(detail_schema(), observer=reports.append)
+        sf(session.query(models.User))
+
+        report, = reports
+        assert report.depth == 3
+        assert report.relationships == 0
+        assert report.columns is None
+        assert 'all columns, 0 relationships' in str(report)
+
+    def test_path_loader_stats(self, session, detail_schema, models):
+        reports = []
+        sf = SchemaFilter(detail_schema(), strategy='defaultload',
+                          path_loaders={'likes': 'selectinload'},
+                          observer=reports.append)
+        sf(session.query(models.User))
+        assert reports[0].relationships == 1, 'only likes'
+
+
+class TestPlan:
+    def test_precompiled(self, session, detail_schema, detail_out, models,
+                         instances):
+        plan = precompile(detail_schema, models.User, unlazify=True)
+        assert plan.cls is models.User
+        with pytest.raises(AttributeError):
+            plan.options = ()
+
+        session.commit()
+        qc_before = query_counter
+
+        qry = session.query(models.User).filter(models.User.id==instances['user_id'])
+        obj = plan(qry).first()
+        qc_fetch = query_counter
+        data = unpack(detail_schema().dump(obj))
+        qc_dump = query_counter
+
+        assert data == detail_out, 'plan: data correct'
+        assert qc_fetch - qc_before == 1, 'plan: 1 to fetch'
+        assert qc_dump - qc_fetch == 0, 'plan: 0 to dump'
+
+    def test_same_sql(self, session, list_schema, models):
+        qry = session.query(models.User)
+        sf = SchemaFilter(list_schema(), unlazify=True)
+        assert str(sf.compile(models.User)(qry)) == str(sf(qry))
+        assert str(qry.options(*sf.compile(models.User))) == str(sf(qry))
+
+    def test_from_config(self, session, detail_schema, models):
+        cfg = projection_config(detail_schema(), models.User)
+        plan = ProjectionPlan.from_config(models.User, cfg,
+                                          loader='joinedload')
+        sf = SchemaFilter(detail_schema(), unlazify=True, cache=False)
+        qry = session.query(models.User)
+        assert str(plan(qry)) == str(sf(qry))
+
+
+class TestPersistedPlans:
+    def test_round_trip(self, session, detail_schema, models, tmp_path):
+        path = str(tmp_path / 'plans.json')
+        export_plans([(SchemaFilter(detail_schema(), unlazify=True),
+                       models.User)], path)
+
+        cache = ProjectionCache()
+        sf = SchemaFilter(detail_schema(), unlazify=True, cache=cache)
+        report = load_plans([(sf, models.User)], path)
+        assert report.loaded == ['UserDetailSchema on User']
+        assert (report.stale, report.missing) == ([], [])
+
+        # no introspection left to do
+        qry = session.query(models.User)
+        sql = str(sf(qry))
+        assert (cache.hits, cache.misses) == (1, 0)
+        uncached = SchemaFilter(detail_schema(), unlazify=True, cache=False)
+        assert sql == str(uncached(qry))
+
+    def test_mismatch(self, detail_schema, list_schema, models):
+        sf = SchemaFilter(detail_schema(), cache=ProjectionCache())
+        data = export_plans([(sf, models.User)])
+
+        # other instance options are another plan
+        other = SchemaFilter(detail_schema(exclude=['email']),
+                             cache=ProjectionCache())
+        assert load_plans([(other, models.User)], data).missing == [
+            'UserDetailSchema on User']
+
+        plan, = data['plans'].values()
+        plan['fingerprint'] = 'f' * 40
+        report = load_plans([(sf, models.User)], data)
+        assert report.stale == ['UserDetailSchema on User']
+        assert len(sf.cache) == 0
+        assert load_plans([(sf, models.User)], data, verify=False).loaded
+
+        data['version'] += 1
+        assert load_plans([(sf, models.User)], data).missing
+
+        # files from before 'lazy' was in the config tree
+        data['version'] = 1
+        for node in plan['config']['nodes']:
+            del node['lazy']
+        assert load_plans([(sf, models.User)], data, verify=False).missing
+
+    def test_shared_subtrees(self, tree_models):
+        cfg = SchemaProjectionGenerator(CategorySchema(), tree_models.Category,
+                                        max_depth=3).config
+        data = dump_config(cfg)
+        # one node per depth, + the leaf
+        assert len(data['nodes']) == 4
+        assert load_config(data) == cfg
+
+
+def test_lazy_import():
+    code = ('import sys, marshmallow_select; '
+            'print(sorted(m for m in ("marshmallow", "sqlalchemy") '
+            'if m in sys.modules))')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == '[]'
+
+
 def manually_project(qry):
     from sqlalchemy.orm import (
         joinedload,
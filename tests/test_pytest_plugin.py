@@ -0,0 +1,60 @@
+import pytest
+import sqlalchemy as sa
+
+pytest_plugins = ['pytester', 'marshmallow_select.pytest_plugin']
+
+
+@pytest.fixture()
+def engine():
+    return sa.create_engine('sqlite:///:memory:', echo=False)
+
+
+def execute(engine, *statements):
+    with engine.connect() as conn:
+        for statement in statements:
+            conn.execute(sa.text(statement))
+
+
+def test_under_budget(assert_max_queries, engine):
+    with assert_max_queries(2, bind=engine) as recorder:
+        execute(engine, 'select 1', 'select 2')
+    assert len(recorder.queries) == 2
+
+
+def test_over_budget(assert_max_queries, engine):
+    with pytest.raises(pytest.fail.Exception) as excinfo:
+        with assert_max_queries(1, bind=engine):
+            execute(engine, 'select 1', 'select 2')
+
+    assert str(excinfo.value).splitlines() == [
+        'expected at most 1 queries, got 2:',
+        '  1. select 1',
+        '+ 2. select 2',
+    ]
+
+
+@pytest.mark.max_queries(1)
+def test_marker(engine):
+    execute(engine, 'select 1')
+
+
+def test_marker_over_budget(pytester):
+    pytester.makepyfile("""
+        import pytest
+        import sqlalchemy as sa
+
+        pytest_plugins = ['marshmallow_select.pytest_plugin']
+
+        @pytest.mark.max_queries(1)
+        def test_chatty():
+            engine = sa.create_engine('sqlite://')
+            with engine.connect() as conn:
+                conn.execute(sa.text('select 1'))
+                conn.execute(sa.text('select 2'))
+    """)
+    result = pytester.runpytest()
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines([
+        '*expected at most 1 queries, got 2:',
+        '*+ 2. select 2',
+    ])